@@ -1,13 +1,27 @@
 # base to build an Android application
 import os
 import glob
+import hashlib
+import json
 import logging
 import string
 import dragon
 import shutil
 import sys
+import time
 
+import apps_tools.archive as archive
+import apps_tools.checksums as checksums
 import apps_tools.common as common
+import apps_tools.compiler_cache as compiler_cache
+import apps_tools.delta as delta
+import apps_tools.fingerprint as fingerprint
+import apps_tools.fsutil as fsutil
+import apps_tools.jobserver as jobserver
+import apps_tools.pressure as pressure
+import apps_tools.store as store
+import apps_tools.symbols as symbols
+import apps_tools.trace as trace
 
 
 class _ndk_version:
@@ -61,23 +75,107 @@ class _ndk_version:
         return not self.__lt__(other)
 
 
-def _get_ndk_version(min_version=None, max_version=None, source='apps_tools'):
-    ndkPath = os.environ.get('ANDROID_NDK_PATH')
-    if not ndkPath:
-        logging.error('ANDROID_NDK_PATH needs to be defined')
-        sys.exit(1)
-    propFile = os.path.join(ndkPath, 'source.properties')
-    with open(propFile, 'r') as f:
+def _probe_cache_file():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'apps_tools', 'ndk-probe.json')
+
+
+def _probe_stamp(paths):
+    stamp = {}
+    for path in paths:
+        try:
+            stamp[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamp[path] = None
+    return stamp
+
+
+def _probe_ndk_files(ndk_path):
+    # Scan the NDK for the facts used by apps_tools
+    prop_file = os.path.join(ndk_path, 'source.properties')
+    version = None
+    with open(prop_file, 'r') as f:
         for line in f:
             if 'Pkg.Revision' not in line:
                 continue
             _, _, v = line.partition('=')
-            v = v.strip()
-    version = v.split('.')
+            version = v.strip().split('.')
+
+    wrap_sh_dir = os.path.join(ndk_path, 'wrap.sh')
+    wrap_sh = {}
+    if os.path.isdir(wrap_sh_dir):
+        for name in os.listdir(wrap_sh_dir):
+            wrap_sh[name] = os.path.join(wrap_sh_dir, name)
+
+    prebuilt_dir = os.path.join(ndk_path, 'toolchains', 'llvm', 'prebuilt')
+    lib_dirs = glob.glob(os.path.join(prebuilt_dir, '*', 'lib64', 'clang',
+                                      '*', 'lib', 'linux'))
+    asan_libs = {}
+    for lib in sorted(glob.glob(os.path.join(
+            prebuilt_dir, '*', 'lib64', 'clang', '*', 'lib', 'linux',
+            'libclang_rt.asan-*-android.so'))):
+        arch = os.path.basename(lib)[len('libclang_rt.asan-'):
+                                     -len('-android.so')]
+        asan_libs.setdefault(arch, lib)
+
+    # Any change in these means the facts above may have changed
+    stamp_paths = [prop_file, wrap_sh_dir, prebuilt_dir]
+    stamp_paths.extend(glob.glob(os.path.join(prebuilt_dir, '*', 'lib64',
+                                              'clang')))
+    stamp_paths.extend(lib_dirs)
+    return {
+        'stamp': _probe_stamp(stamp_paths),
+        'version': version,
+        'wrap_sh': wrap_sh,
+        'asan_libs': asan_libs,
+    }
+
+
+_NDK_PROBE = None
+
+
+def _probe_ndk():
+    # NDK facts, cached in memory and in a persistent cache keyed by the
+    # NDK path and the mtimes of what was probed, so that a warm run only
+    # stats a few paths.
+    global _NDK_PROBE
+    if _NDK_PROBE is not None:
+        return _NDK_PROBE
+    ndk_path = os.environ.get('ANDROID_NDK_PATH')
+    if not ndk_path:
+        logging.error('ANDROID_NDK_PATH needs to be defined')
+        sys.exit(1)
+    ndk_path = os.path.abspath(ndk_path)
+
+    cache_file = _probe_cache_file()
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    probe = cache.get(ndk_path)
+    if probe is None or probe['stamp'] != _probe_stamp(probe['stamp']):
+        probe = _probe_ndk_files(ndk_path)
+        cache[ndk_path] = probe
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp = '{}.{}'.format(cache_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            logging.debug('Unable to save ndk probe cache: %s', e)
+    _NDK_PROBE = probe
+    return probe
+
+
+def _get_ndk_version(min_version=None, max_version=None, source='apps_tools'):
+    version = _probe_ndk()['version'] or []
     try:
         version = [int(x) for x in version[:2]]
         version = _ndk_version(version[0], version[1])
-    except ValueError:
+    except (ValueError, IndexError):
         logging.error('Unable to read android ndk version')
         sys.exit(1)
     if min_version is not None and version < min_version:
@@ -94,18 +192,26 @@ def _get_ndk_version(min_version=None, max_version=None, source='apps_tools'):
 _NDK_VERSION = None
 
 
+_NDK_CHECKS = []
+
+
 def _init():
+    # Probe the NDK on first use only (task execution), so that registering
+    # tasks or showing the help does not depend on it
     global _NDK_VERSION
     if _NDK_VERSION is None:
         _NDK_VERSION = _get_ndk_version()
         logging.info('Installed NDK version: {}'.format(_NDK_VERSION))
+        for minv, maxv in _NDK_CHECKS:
+            _get_ndk_version(minv, maxv, source='product')
 
 
 def check_ndk_version(min_version=None, max_version=None):
-    _init()
     minv = _ndk_version(min_version) if min_version else None
     maxv = _ndk_version(max_version) if max_version else None
-    _get_ndk_version(minv, maxv, source='product')
+    _NDK_CHECKS.append((minv, maxv))
+    if _NDK_VERSION is not None:
+        _get_ndk_version(minv, maxv, source='product')
 
 
 def setup_argparse(parser):
@@ -115,11 +221,158 @@ def setup_argparse(parser):
                         choices=('armeabi', 'armeabi-v7a', 'arm64-v8a',
                                  'x86', 'x86_64'),
                         help='Select which android ABIS to build')
-
-
-def _setup_android_abi(task, args, abi):
+    parser.add_argument('--parallel-common',
+                        dest='android_parallel_common',
+                        action='store_true',
+                        help='Build common code of all ABIS concurrently')
+    parser.add_argument('--compiler-cache',
+                        dest='android_compiler_cache',
+                        choices=compiler_cache.TOOLS + ('none',),
+                        help='Compiler cache of the native builds')
+    parser.add_argument('--ndk-fan-out',
+                        dest='android_ndk_fan_out',
+                        action='store_true',
+                        help='Run one ndk-build per ABI concurrently')
+    parser.add_argument('--gradle-performance',
+                        dest='android_gradle_performance',
+                        action='store_true',
+                        help='Use gradle build and configuration caches, ' +
+                        'parallel projects and a warm daemon')
+    parser.add_argument('--artifact-cache',
+                        dest='android_artifact_cache',
+                        metavar='DIR',
+                        help='Cache of the build-common-<abi> outputs')
+
+
+# Compiler cache and its stats before the build, by task
+_CACHE_STATS = {}
+
+
+def _setup_android_abi(task, args, abi, cache_tool=None):
+    _init()
     task.call_base_pre_hook(args)
     task.extra_env['ANDROID_ABI'] = abi
+    _unshare_common(abi)
+    cache = compiler_cache.get(cache_tool, _NDK_VERSION, abi)
+    if cache is not None:
+        # alchemy prefixes the compilers with $(CCACHE) if USE_CCACHE is set
+        task.extra_env.update(cache.env())
+        task.extra_env['USE_CCACHE'] = '1'
+        task.extra_env['CCACHE'] = cache.path
+        _CACHE_STATS[task.name] = (cache, cache.stats())
+
+
+def _report_compiler_cache(task):
+    cache, before = _CACHE_STATS.pop(task.name, (None, None))
+    if cache is not None:
+        trace.annotate(**compiler_cache.report(task.name, cache, before,
+                                               cache.stats()))
+
+# Artifact cache of the build-common-<abi> outputs
+
+
+# In OUT_DIR/<abi>: key of the outputs, and whether they were restored
+# from the cache (hardlinks of its files)
+_ARTIFACT_MARKER = '.artifact-cache.json'
+
+# Not cached: intermediate files only used by incremental builds, files
+# written in place later
+_ARTIFACT_IGNORE = ('build', 'alchemy-database.xml', _ARTIFACT_MARKER)
+
+# Store and key of the outputs to cache, by task
+_ARTIFACTS = {}
+
+# Digest of the sources of the cached outputs, by inputs
+_SOURCES_DIGESTS = {}
+
+# Environment variable giving the digest of the sources to the instances
+# run by _build_common_parallel
+_SOURCES_DIGEST_ENV = 'APPS_TOOLS_SOURCES_DIGEST'
+
+
+def _read_artifact_marker(abi):
+    try:
+        with open(os.path.join(dragon.OUT_DIR, abi, _ARTIFACT_MARKER),
+                  'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_artifact_marker(abi, key, restored):
+    with open(os.path.join(dragon.OUT_DIR, abi, _ARTIFACT_MARKER), 'w') as f:
+        json.dump({'key': key, 'restored': restored}, f)
+
+
+def _unshare_common(abi):
+    # Outputs restored from the cache share their files with it: remove
+    # them before anything builds over them
+    if _read_artifact_marker(abi).get('restored'):
+        logging.info('Removing outputs of %s restored from cache', abi)
+        fsutil.trash(os.path.join(dragon.OUT_DIR, abi))
+
+
+def _sources_digest(inputs, artifact_store):
+    # Digest of the sources of build-common, computed once for all the abis
+    # (by the parent instance in parallel builds)
+    if os.environ.get(_SOURCES_DIGEST_ENV):
+        return os.environ[_SOURCES_DIGEST_ENV]
+    inputs = inputs or [dragon.WORKSPACE_DIR]
+    key = tuple(inputs)
+    if key not in _SOURCES_DIGESTS:
+        # The cache may be in the workspace, modified by each build
+        stamp = fingerprint.Fingerprint(
+            'artifacts-sources',
+            os.path.join(dragon.OUT_DIR, '.fingerprints'),
+            inputs=inputs, values={},
+            excludes=fingerprint.EXCLUDES + (
+                os.path.basename(dragon.OUT_ROOT_DIR),
+                os.path.abspath(artifact_store.root)),
+            jobs=dragon.OPTIONS.jobs.job_num)
+        _SOURCES_DIGESTS[key] = stamp.digest()
+        # The digests of the files are kept whatever the build result, for
+        # the next build to only hash the modified ones
+        stamp.save()
+    return _SOURCES_DIGESTS[key]
+
+
+def _restore_common(name, abi, asan, artifact_store, inputs):
+    # Restore the outputs of build-common-<abi> from the cache, return
+    # False if they need to be built
+    digest = hashlib.sha256(json.dumps({
+        'sources': _sources_digest(inputs, artifact_store),
+        'product': dragon.PRODUCT,
+        'variant': dragon.VARIANT,
+        'abi': abi,
+        'ndk': str(_NDK_VERSION),
+        'asan': asan,
+    }, sort_keys=True).encode()).hexdigest()
+    key = os.path.join('build-common', abi, digest)
+    if _read_artifact_marker(abi).get('key') == key:
+        logging.info('%s: up to date', name)
+        return True
+    out_dir = os.path.join(dragon.OUT_DIR, abi)
+    if artifact_store.has(key):
+        with trace.span('{}:restore'.format(name)):
+            fsutil.trash(out_dir)
+            if artifact_store.restore_tree(key, out_dir):
+                _write_artifact_marker(abi, key, True)
+                logging.info('%s: restored from %s', name,
+                             artifact_store.root)
+                return True
+    _ARTIFACTS[name] = (artifact_store, key)
+    return False
+
+
+def _store_common(name, abi):
+    artifact_store, key = _ARTIFACTS.pop(name, (None, None))
+    if artifact_store is None:
+        return
+    if artifact_store.put_tree(key, os.path.join(dragon.OUT_DIR, abi),
+                               ignore=_ARTIFACT_IGNORE):
+        logging.info('%s: stored in %s', name, artifact_store.root)
+    artifact_store.evict(keep=[key])
+    _write_artifact_marker(abi, key, False)
 
 # Address sanitizer setup/cleanup
 
@@ -148,21 +401,22 @@ def _gen_asan_wrapper(abi, lib_dir, script_dir):
     else:
         # Post r21, use asan.sh script
         wrap_sh_name = 'asan.sh'
-    wrap_sh_path = os.path.join(ndk_path, 'wrap.sh', wrap_sh_name)
-    shutil.copyfile(wrap_sh_path, os.path.join(script_dir, 'wrap.sh'))
+    probe = _probe_ndk()
+    wrap_sh_path = probe['wrap_sh'].get(wrap_sh_name,
+                                        os.path.join(ndk_path, 'wrap.sh',
+                                                     wrap_sh_name))
+    fsutil.stage_file(wrap_sh_path, os.path.join(script_dir, 'wrap.sh'))
 
     asan_lib_fname = 'libclang_rt.asan-{}-android.so'.format(abi)
-    asan_libs = glob.glob(os.path.join(ndk_path, 'toolchains', 'llvm',
-                                       'prebuilt', '*', 'lib64', 'clang', '*',
-                                       'lib', 'linux', asan_lib_fname))
-    if not asan_libs:
+    asan_lib_path = probe['asan_libs'].get(abi)
+    if not asan_lib_path:
         logging.info('Unable to find asan library while setting asan_wrapper')
         return
-    asan_lib_path = asan_libs[0]
-    shutil.copyfile(asan_lib_path, os.path.join(lib_dir, asan_lib_fname))
+    fsutil.stage_file(asan_lib_path, os.path.join(lib_dir, asan_lib_fname))
 
 
 def _asan_setup(abi):
+    _init()
     asan_out_dir = os.path.join(dragon.OUT_DIR, 'asan')
     asan_lib_dir = os.path.join(asan_out_dir, 'libs', abi)
     asan_script_dir = os.path.join(asan_out_dir, 'scripts', 'lib', abi)
@@ -181,22 +435,39 @@ def _asan_clean(abi):
 # Register a task to build android common code for a specific abi/arch
 
 
-def _add_android_abi(abi, asan=False):
+def _add_android_abi(abi, asan=False, cache_tool=None, artifact_store=None,
+                     artifact_inputs=None, parallel=False):
 
     # Create asan wrapper scripts if required
     asan_build_func = _asan_setup if asan else _asan_clean
 
+    def _pre_build(task, args):
+        # Outputs of a build with specific arguments are not cached
+        if artifact_store is not None and not args:
+            _init()
+            if _restore_common(task.name, abi, asan, artifact_store,
+                               artifact_inputs):
+                asan_build_func(abi)
+                raise dragon.TaskExit()
+        _setup_android_abi(task, args, abi, cache_tool)
+
+    def _post_build(task, args):
+        asan_build_func(abi)
+        _report_compiler_cache(task)
+        _store_common(task.name, abi)
+
     dragon.add_alchemy_task(
         name='build-common-{}'.format(abi),
         desc='Build android common for {}'.format(abi),
         product=dragon.PRODUCT,
         variant=dragon.VARIANT,
         defargs=['all', 'sdk'],
-        prehook=lambda task, args: _setup_android_abi(task, args, abi),
-        posthook=lambda task, args: asan_build_func(abi),
+        prehook=_pre_build,
+        posthook=trace.hook('post-build', _post_build),
         weak=True,
         outsubdir=abi,
-        host_in_subdir=False,
+        # The abis built concurrently must not share the host modules
+        host_in_subdir=parallel,
         secondary_help=True
     )
 
@@ -207,27 +478,51 @@ def _add_android_abi(abi, asan=False):
         variant=dragon.VARIANT,
         defargs=['clobber'],
         prehook=lambda task, args: _setup_android_abi(task, args, abi),
-        posthook=lambda task, args: _asan_clean(abi),
+        posthook=trace.hook('asan-clean', lambda task, args: _asan_clean(abi)),
         weak=True,
         outsubdir=abi,
-        host_in_subdir=False,
+        host_in_subdir=parallel,
         secondary_help=True
     )
 
 
-def _ndk_build(calldir, module, abis, extra_args, ignore_failure=False):
-
+def _asan_enabled():
     # Check if asan is used
     raw_asan = dragon.get_alchemy_var('USE_ADDRESS_SANITIZER')
     if not raw_asan or raw_asan == '0':
-        asan = False
-    else:
-        asan = True
+        return False
+    return True
 
-    outdir = os.path.join(dragon.OUT_DIR, 'jni', module)
+
+def _fingerprint(name, inputs, values, outputs):
+    values = dict(values, ndk=os.environ.get('ANDROID_NDK_PATH'))
+    # The out directory is in the workspace: the current directory when no
+    # calldir is given
+    return fingerprint.Fingerprint(
+        name, os.path.join(dragon.OUT_DIR, '.fingerprints'),
+        inputs=inputs, values=values, outputs=outputs,
+        excludes=fingerprint.EXCLUDES + (
+            os.path.basename(dragon.OUT_ROOT_DIR),),
+        jobs=dragon.OPTIONS.jobs.job_num)
+
+
+def _alchemy_inputs(abis):
+    # sdk and staging directories of the alchemy builds of abis (all the
+    # abis built if none given): the native dependencies of the ndk-build
+    # and gradle builds
+    if not abis:
+        abis = sorted(os.path.basename(os.path.dirname(path)) for path in
+                      glob.glob(os.path.join(dragon.OUT_DIR, '*', 'staging')))
+    return [os.path.join(dragon.OUT_DIR, abi, subdir)
+            for abi in abis for subdir in ('sdk', 'staging')]
+
+
+def _ndk_build_cmd(outdir, abis, asan, suffix=''):
     cmd = ['${ANDROID_NDK_PATH}/ndk-build']
+    # The unstripped libs stay in obj/local/<abi> for the symbols
     cmd.append('NDK_OUT={}'.format(os.path.join(outdir, 'obj')))
-    cmd.append('NDK_LIBS_OUT={}'.format(os.path.join(outdir, 'libs')))
+    cmd.append('NDK_LIBS_OUT={}'.format(os.path.join(outdir,
+                                                     'libs' + suffix)))
     cmd.append('PRODUCT_DIR={}'.format(os.path.join(dragon.WORKSPACE_DIR,
                                                     'products', dragon.PRODUCT,
                                                     dragon.VARIANT)))
@@ -235,31 +530,241 @@ def _ndk_build(calldir, module, abis, extra_args, ignore_failure=False):
     cmd.append('APP_ABI="{}"'.format(' '.join(abis)))
     if asan:
         cmd.append('LOCAL_ALLOW_UNDEFINED_SYMBOLS=true')
+    return cmd
+
+
+def _merge_abi_libs(src, dst):
+    # Move the libs of an abi built in src to dst, removing what is no
+    # longer built
+    kept = set()
+    for dirpath, _, filenames in os.walk(src):
+        destdir = os.path.normpath(
+            os.path.join(dst, os.path.relpath(dirpath, src)))
+        os.makedirs(destdir, exist_ok=True)
+        for filename in filenames:
+            kept.add(os.path.join(destdir, filename))
+            os.replace(os.path.join(dirpath, filename),
+                       os.path.join(destdir, filename))
+    for dirpath, _, filenames in os.walk(dst):
+        for filename in filenames:
+            if os.path.join(dirpath, filename) not in kept:
+                os.unlink(os.path.join(dirpath, filename))
+
+
+def _ndk_build_fan_out(calldir, module, outdir, abis, asan, extra_args,
+                       cache_tool):
+    # One ndk-build per abi, all running concurrently as clients of the
+    # shared jobserver (or with a share of the -j budget without it). The
+    # objects of each abi are in their own NDK_OUT/local/<abi>, but each
+    # ndk-build has its own NDK_LIBS_OUT (ndk-build removes the libs of the
+    # other abis from its NDK_LIBS_OUT): the libs of the successful ones are
+    # then moved to the usual outdir/libs/<abi>, the libs of other abis
+    # removed.
+    cmds = []
+    caches = []
+    jobs = common.split_jobs(dragon.OPTIONS.jobs.job_num, len(abis))
+    for abi, job_num in zip(abis, jobs):
+        cmd = _ndk_build_cmd(outdir, [abi], asan, '-{}'.format(abi))
+        cmd.extend(extra_args)
+        cache = compiler_cache.get(cache_tool, _NDK_VERSION, abi)
+        if cache is not None:
+            cmd[:0] = ['{}={}'.format(key, value)
+                       for key, value in sorted(cache.ndk_env().items())]
+            caches.append((abi, cache, cache.stats()))
+        cmd = jobserver.make_cmd(' '.join(cmd), job_num)
+        name = 'ndk-build-{}-{}'.format(module, abi)
+        log_file = os.path.join(dragon.OUT_DIR, 'logs',
+                                '{}.log'.format(name))
+        cmds.append((name, lambda _, cmd=cmd: cmd, calldir, log_file))
+
+    pressure.wait('ndk-build')
+    # A slot each for the implicit job of the make clients
+    failed = common.exec_cmds_parallel(cmds, jobs=[1] * len(cmds),
+                                       check=False)
+    for abi, cache, stats in caches:
+        compiler_cache.report('ndk-build {} {}'.format(module, abi), cache,
+                              stats, cache.stats())
+
+    failed_abis = [abi for abi, entry in zip(abis, cmds)
+                   if entry[0] in failed]
+    for abi in abis:
+        libs_dir = os.path.join(outdir, 'libs-{}'.format(abi))
+        if abi not in failed_abis:
+            _merge_abi_libs(os.path.join(libs_dir, abi),
+                            os.path.join(outdir, 'libs', abi))
+        shutil.rmtree(libs_dir, ignore_errors=True)
+    # As ndk-build does in its NDK_LIBS_OUT: no libs of other abis (built
+    # before) to be packaged
+    for libs_dir in glob.glob(os.path.join(outdir, 'libs', '*')):
+        if os.path.basename(libs_dir) not in abis:
+            shutil.rmtree(libs_dir, ignore_errors=True)
+    if failed_abis:
+        raise dragon.ExecError('ndk-build {} failed for {}'.format(
+            module, ', '.join(failed_abis)))
+
+
+def _ndk_build(calldir, module, abis, extra_args, ignore_failure=False,
+               use_fingerprint=False, inputs=None, cache_tool=None,
+               fan_out=False):
+
+    _init()
+    asan = _asan_enabled()
+
+    outdir = os.path.join(dragon.OUT_DIR, 'jni', module)
+    cmd = _ndk_build_cmd(outdir, abis, asan)
+
+    # Skip the build if nothing changed since the last successful one
+    stamp = None
+    if use_fingerprint:
+        # No calldir: ndk-build runs in the current directory
+        stamp = _fingerprint('ndk-build-{}'.format(module),
+                             inputs or [os.path.abspath(calldir or '.')] +
+                             _alchemy_inputs(abis),
+                             {'cmd': cmd, 'extra_args': extra_args},
+                             [os.path.join(outdir, 'libs')])
+        if stamp.up_to_date():
+            logging.info('ndk-build %s: up to date', module)
+            return
+
     if dragon.OPTIONS.verbose:
-        cmd.append('V=1')
-    cmd.append('-j{}'.format(dragon.OPTIONS.jobs.job_num))
+        extra_args = ['V=1'] + list(extra_args)
+
+    # The compiler caches are per abi: one ndk-build per abi to use them
+    if ((fan_out or compiler_cache.enabled(cache_tool)) and
+            len(abis) > 1):
+        try:
+            _ndk_build_fan_out(calldir, module, outdir, abis, asan,
+                               extra_args, cache_tool)
+        except dragon.ExecError:
+            if not ignore_failure:
+                raise
+            return
+        if stamp:
+            stamp.save()
+        return
+
     cmd.extend(extra_args)
+    cache = None
+    if len(abis) == 1:
+        cache = compiler_cache.get(cache_tool, _NDK_VERSION, abis[0])
+    if cache is not None:
+        cmd[:0] = ['{}={}'.format(key, value)
+                   for key, value in sorted(cache.ndk_env().items())]
+        stats = cache.stats()
     try:
-        dragon.exec_cmd(cmd=' '.join(cmd), cwd=calldir)
+        # ndk-build is a make client of the shared jobserver
+        pressure.wait('ndk-build')
+        with jobserver.slots(1):
+            common.exec_cmd(jobserver.make_cmd(
+                ' '.join(cmd), dragon.OPTIONS.jobs.job_num),
+                cwd=calldir, name='ndk-build')
     except dragon.ExecError:
         if not ignore_failure:
             raise
+        return
+    finally:
+        if cache is not None:
+            trace.annotate(**compiler_cache.report(
+                'ndk-build {}'.format(module), cache, stats, cache.stats()))
+    if stamp:
+        stamp.save()
 
 
 def add_ndk_build_task(*, calldir='', module='', abis=[], extra_args=[],
-                       ignore_failure=False, **kwargs):
-    _init()
+                       ignore_failure=False, use_fingerprint=False,
+                       inputs=None, use_compiler_cache=None, fan_out=False,
+                       **kwargs):
     if dragon.OPTIONS.android_abis:
         abis = dragon.OPTIONS.android_abis
+    if getattr(dragon.OPTIONS, 'android_compiler_cache', None):
+        use_compiler_cache = dragon.OPTIONS.android_compiler_cache
+    if getattr(dragon.OPTIONS, 'android_ndk_fan_out', None):
+        fan_out = True
     dragon.add_meta_task(
-        posthook=lambda task, dragon_args: _ndk_build(calldir, module, abis,
-                                                      extra_args,
-                                                      ignore_failure),
+        posthook=trace.hook('ndk-build', lambda task, dragon_args: _ndk_build(
+            calldir, module, abis, extra_args, ignore_failure,
+            use_fingerprint, inputs, use_compiler_cache, fan_out)),
         **kwargs
     )
 
 
-def _gradle(calldir, abis, extra_args):
+# Init script of gradle in the performance profile: local build cache
+# directory, end of the configuration (task graph ready) written to a file
+_GRADLE_INIT_SCRIPT = '''// Generated by apps_tools
+gradle.settingsEvaluated {{ settings ->
+    settings.buildCache {{
+        local {{
+            directory = new File('{cache_dir}')
+        }}
+    }}
+}}
+gradle.taskGraph.whenReady {{
+    new File('{timing_file}').text = System.currentTimeMillis().toString()
+}}
+'''
+
+# Idle time after which a gradle daemon exits (ms). Long enough to be
+# reused by all gradle tasks of a release, short enough to not keep its
+# memory for long after.
+_GRADLE_DAEMON_IDLE_TIMEOUT = 10 * 60 * 1000
+
+
+def _gradle_build_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'apps_tools', 'gradle-build-cache')
+
+
+def _gradle_performance_args(calldir, properties, build_cache_dir):
+    # Arguments of the performance profile: build cache, configuration
+    # cache, parallel projects, warm daemon. Return (args, timing file).
+    gradle_dir = os.path.join(dragon.OUT_DIR, 'gradle')
+    os.makedirs(gradle_dir, exist_ok=True)
+    name = hashlib.sha256(os.path.abspath(calldir).encode()).hexdigest()[:16]
+    timing_file = os.path.join(gradle_dir, '{}.configured'.format(name))
+    if os.path.exists(timing_file):
+        os.unlink(timing_file)
+    init_script = os.path.join(gradle_dir, 'init-{}.gradle'.format(name))
+    with open(init_script, 'w') as f:
+        f.write(_GRADLE_INIT_SCRIPT.format(
+            cache_dir=build_cache_dir or _gradle_build_cache_dir(),
+            timing_file=timing_file))
+
+    # The properties given to gradle are inputs of its configuration:
+    # drop the configuration cache when they change, whatever gradle
+    # tracks itself
+    if os.environ.get('MOVE_APPSDATA_IN_OUTDIR'):
+        project_cache_dir = os.path.join(dragon.OUT_DIR, '.gradle')
+    else:
+        project_cache_dir = os.path.join(calldir, '.gradle')
+    state_file = os.path.join(gradle_dir, '{}.properties.json'.format(name))
+    try:
+        with open(state_file, 'r') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if previous is not None and previous != properties:
+        logging.info('gradle properties changed, dropping configuration '
+                     'cache of %s', calldir)
+        fsutil.trash(os.path.join(project_cache_dir, 'configuration-cache'))
+    with open(state_file, 'w') as f:
+        json.dump(properties, f)
+
+    args = [
+        '--init-script {}'.format(init_script),
+        '--build-cache',
+        '--configuration-cache',
+        '--parallel',
+        '--daemon',
+        '-Dorg.gradle.daemon.idletimeout={}'.format(
+            _GRADLE_DAEMON_IDLE_TIMEOUT),
+    ]
+    return args, timing_file
+
+
+def _gradle(calldir, abis, extra_args, stamp_name=None, inputs=None,
+            outputs=(), performance=False, build_cache_dir=None):
+    _init()
     # get the real version
     version = dragon.PARROT_BUILD_VERSION
     # create a fake version which is a pure release from the current version
@@ -276,9 +781,29 @@ def _gradle(calldir, abis, extra_args):
     # Version code is generated by the complete version
     vcode = common.get_version_code(version)
 
+    # Skip the build if nothing changed since the last successful one
+    stamp = None
+    if stamp_name:
+        if not inputs:
+            # Sources (no calldir: the current directory), libs of the
+            # ndk-build modules and alchemy outputs
+            inputs = [os.path.abspath(calldir or '.')]
+            inputs.extend(sorted(glob.glob(os.path.join(
+                dragon.OUT_DIR, 'jni', '*', 'libs'))))
+            inputs.extend(_alchemy_inputs(abis))
+        stamp = _fingerprint(stamp_name, inputs, {
+            'abis': abis,
+            'extra_args': extra_args,
+            'version': [vname, suffix, vcode],
+            'asan': _asan_enabled(),
+        }, outputs)
+        if stamp.up_to_date():
+            logging.info('gradle %s: up to date', stamp_name)
+            return
+
     cmd = ['./gradlew']
     if os.environ.get('MOVE_APPSDATA_IN_OUTDIR'):
-        cmd.append('--project-cache-dir {}'.foramt(os.path.join(dragon.OUT_DIR,
+        cmd.append('--project-cache-dir {}'.format(os.path.join(dragon.OUT_DIR,
                                                                 '.gradle')))
     cmd.append('-PalchemyOutRoot={}'.format(dragon.OUT_ROOT_DIR))
     cmd.append('-PalchemyOut={}'.format(dragon.OUT_DIR))
@@ -289,58 +814,204 @@ def _gradle(calldir, abis, extra_args):
     if suffix:
         cmd.append('-PappVersionNameSuffix={}'.format(suffix))
     cmd.append('-PappVersionCode={}'.format(vcode))
+    timing_file = None
+    if performance:
+        args, timing_file = _gradle_performance_args(
+            calldir, [arg for arg in cmd if arg.startswith('-P')],
+            build_cache_dir)
+        cmd.extend(args)
     cmd.extend(extra_args)
-    dragon.exec_cmd(' '.join(cmd), cwd=calldir)
-
-
-def add_gradle_task(*, calldir, target='', abis=[], extra_args=[], **kwargs):
-    _init()
+    # Gradle does not know the jobserver: limit its workers to the slots
+    # held while it runs
+    pressure.wait('gradle')
+    with jobserver.slots(dragon.OPTIONS.jobs.job_num) as workers:
+        if workers:
+            cmd.append('--max-workers={}'.format(workers))
+        start = time.time()
+        common.exec_cmd(' '.join(cmd), cwd=calldir)
+        end = time.time()
+    if timing_file:
+        # No timing file: the configuration was loaded from the cache
+        try:
+            with open(timing_file, 'r') as f:
+                configured = int(f.read().strip()) / 1000
+        except (OSError, ValueError):
+            configured = start
+        configured = min(max(configured, start), end)
+        logging.info('gradle: configuration %.1fs, execution %.1fs',
+                     configured - start, end - configured)
+        trace.annotate(configuration=round(configured - start, 3),
+                       execution=round(end - configured, 3))
+    if stamp:
+        stamp.save()
+
+
+def add_gradle_task(*, calldir, target='', abis=[], extra_args=[],
+                    use_fingerprint=False, inputs=None, outputs=(),
+                    performance=False, build_cache_dir=None, **kwargs):
     if dragon.OPTIONS.android_abis:
         abis = dragon.OPTIONS.android_abis
+    if getattr(dragon.OPTIONS, 'android_gradle_performance', None):
+        performance = True
     _args = [target]
     _args.extend(extra_args)
+    stamp_name = None
+    if use_fingerprint:
+        # Without outputs a removed apk would not be built again
+        if not outputs:
+            raise dragon.SetupError('gradle {}: fingerprint without '
+                                    'outputs'.format(
+                                        kwargs.get('name') or target))
+        stamp_name = 'gradle-{}'.format(kwargs.get('name') or target)
     dragon.add_meta_task(
-        posthook=lambda task, dragon_args: _gradle(calldir, abis, _args),
+        posthook=trace.hook('gradle', lambda task, dragon_args: _gradle(
+            calldir, abis, _args, stamp_name, inputs, outputs, performance,
+            build_cache_dir)),
         **kwargs
     )
 
 
+# Directories without build description. Unlike fingerprint.EXCLUDES,
+# 'build' is scanned: workspaces keep makefiles in build/ directories.
+_ALCHEMY_SCAN_EXCLUDES = ('.git', '.repo', '.gradle', '.idea', '.cxx',
+                          '.externalNativeBuild')
+
+
+def _dump_alchemy_database(abi):
+    # Dump the alchemy database of abi, unless no build description changed
+    # since the last dump: makefiles of the workspace and alchemy, product
+    # configuration. Alchemy can not evaluate only some makefiles, any
+    # change means a full dump.
+    dump_xml = os.path.join(dragon.OUT_DIR, abi, 'alchemy-database.xml')
+    state_file = os.path.join(dragon.OUT_DIR, '.fingerprints',
+                              'alchemy-database-{}.json'.format(abi))
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+
+    product_dir = os.path.join(dragon.WORKSPACE_DIR, 'products',
+                               dragon.PRODUCT, dragon.VARIANT)
+    tops = [dragon.WORKSPACE_DIR]
+    # Alchemy is usually in the workspace, not to be scanned twice
+    if not dragon.ALCHEMY_HOME.startswith(dragon.WORKSPACE_DIR + os.sep):
+        tops.append(dragon.ALCHEMY_HOME)
+    dirs = state.get('dirs', {})
+    files = fingerprint.scan(
+        tops,
+        lambda dirpath, name: (name.endswith('.mk') or
+                               dirpath == product_dir or
+                               dirpath.startswith(product_dir + os.sep)),
+        dirs,
+        excludes=_ALCHEMY_SCAN_EXCLUDES + (
+            os.path.basename(dragon.OUT_ROOT_DIR),))
+    key = hashlib.sha256(json.dumps(
+        [dragon.PRODUCT, dragon.VARIANT, abi, files]).encode()).hexdigest()
+
+    def _signature():
+        try:
+            st = os.stat(dump_xml)
+        except FileNotFoundError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    xml = _signature()
+    if xml is not None and state.get('key') == key and \
+            state.get('xml') == xml:
+        logging.info('%s: up to date', dump_xml)
+        return dump_xml
+
+    common.exec_cmd('./build.sh -p {}-{} --abis {} -A dump-xml'.format(
+        dragon.PRODUCT, dragon.VARIANT, abi))
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    tmp = '{}.tmp'.format(state_file)
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'xml': _signature(), 'dirs': dirs}, f)
+    os.replace(tmp, state_file)
+    return dump_xml
+
+
 def _hook_alchemy_genproject_android(task, args, abi):
+    _init()
     script_path = os.path.join(dragon.ALCHEMY_HOME, 'scripts',
                                'genproject', 'genproject.py')
     subscript_name = task.name.replace('gen', '')
 
     if '-h' in args or '--help' in args:
-        dragon.exec_cmd('{} {} -h'.format(script_path, subscript_name))
+        common.exec_cmd('{} {} -h'.format(script_path, subscript_name),
+                        capture=False)
         dragon.LOGW(
             'Note: The -b option and dump_xml file are automatically given.')
         raise dragon.TaskExit()
 
-    dragon.exec_cmd(cmd='./build.sh -p {}-{} --abis {} -A dump-xml'.format(
-                        dragon.PRODUCT, dragon.VARIANT, abi))
-    dump_xml = os.path.join(dragon.OUT_DIR, abi, 'alchemy-database.xml')
+    dump_xml = _dump_alchemy_database(abi)
     cmd_args = [script_path, subscript_name,
                 '-b', "'-p {}-{} --abis {} -A'".format(
                     dragon.PRODUCT, dragon.VARIANT, abi),
                 dump_xml, ' '.join(args)]
-    dragon.exec_cmd(' '.join(cmd_args))
-
-
-def add_task_build_common(android_abis, default_abi=None):
-    _init()
+    common.exec_cmd(' '.join(cmd_args))
+
+
+def _build_common_parallel(android_abis, cache_tool, artifact_store,
+                           artifact_inputs):
+    # Run each build-common-<abi> task in its own dragon instance, sharing
+    # the -j budget (jobserver slots) between them. Outputs are already
+    # separated by abi.
+    env = ''
+    if artifact_store is not None:
+        # The sources are hashed here, not by each instance
+        env = '{}={} '.format(_SOURCES_DIGEST_ENV, _sources_digest(
+            artifact_inputs, artifact_store))
+    jobs = common.split_jobs(dragon.OPTIONS.jobs.job_num, len(android_abis))
+    log_dir = os.path.join(dragon.OUT_DIR, 'logs')
+    # Same options as this instance, --parallel-common for the host modules
+    # to be built per abi
+    options = common.forwarded_options(
+        exclude=('android_abis', 'android_parallel_common'))
+    cmds = []
+    for abi in android_abis:
+        name = 'build-common-{}'.format(abi)
+        cmd = '{}./build.sh -p {}-{} --abis {} --parallel-common {}'.format(
+            env, dragon.PRODUCT, dragon.VARIANT, abi, options)
+        cmds.append((name, lambda job_num, cmd=cmd, name=name:
+                     '{} -j{} -t {}'.format(cmd, job_num, name),
+                     dragon.WORKSPACE_DIR,
+                     os.path.join(log_dir, '{}.log'.format(name))))
+    try:
+        common.exec_cmds_parallel(cmds, jobs=jobs)
+    finally:
+        # For their sccache servers to be stopped with the ones of this
+        # instance
+        _init()
+        for abi in android_abis:
+            compiler_cache.get(cache_tool, _NDK_VERSION, abi)
+
+
+def add_task_build_common(android_abis, default_abi=None, *,
+                          parallel=False, use_compiler_cache=None,
+                          artifact_cache_dir=None,
+                          artifact_cache_max_size=None,
+                          artifact_cache_inputs=None):
     if dragon.OPTIONS.android_abis:
         android_abis = dragon.OPTIONS.android_abis
-
-    # Check if asan is used
-    raw_asan = dragon.get_alchemy_var('USE_ADDRESS_SANITIZER')
-    if not raw_asan or raw_asan == '0':
-        asan = False
-    else:
-        asan = True
+    if getattr(dragon.OPTIONS, 'android_parallel_common', None):
+        parallel = True
+    if getattr(dragon.OPTIONS, 'android_compiler_cache', None):
+        use_compiler_cache = dragon.OPTIONS.android_compiler_cache
+    if getattr(dragon.OPTIONS, 'android_artifact_cache', None):
+        artifact_cache_dir = dragon.OPTIONS.android_artifact_cache
+
+    asan = _asan_enabled()
+    artifact_store = None
+    if artifact_cache_dir:
+        artifact_store = store.Store(artifact_cache_dir,
+                                     artifact_cache_max_size)
 
     # Register all abi/arch\
     for abi in android_abis:
-        _add_android_abi(abi, asan)
+        _add_android_abi(abi, asan, use_compiler_cache, artifact_store,
+                         artifact_cache_inputs, parallel)
 
     # Update basic alchemy task to use default abi
     if not default_abi:
@@ -369,13 +1040,25 @@ def add_task_build_common(android_abis, default_abi=None):
         )
 
     # Meta-task to build all common code abi/arch
-    dragon.add_meta_task(
-        name='build-common',
-        desc='Build android common code for all architectures',
-        subtasks=['build-common-' + abi for abi in android_abis],
-        weak=True,
-        secondary_help=True
-    )
+    if parallel and len(android_abis) > 1:
+        dragon.add_meta_task(
+            name='build-common',
+            desc='Build android common code for all architectures',
+            posthook=trace.hook('parallel', lambda task, args:
+                                _build_common_parallel(
+                                    android_abis, use_compiler_cache,
+                                    artifact_store, artifact_cache_inputs)),
+            weak=True,
+            secondary_help=True
+        )
+    else:
+        dragon.add_meta_task(
+            name='build-common',
+            desc='Build android common code for all architectures',
+            subtasks=['build-common-' + abi for abi in android_abis],
+            weak=True,
+            secondary_help=True
+        )
     dragon.add_meta_task(
         name='clean-common',
         desc='Clean android common code for all architectures',
@@ -386,8 +1069,8 @@ def add_task_build_common(android_abis, default_abi=None):
 
 
 def _hook_pre_images(task, args):
-    # cleanup
-    dragon.exec_cmd(cwd=dragon.OUT_DIR, cmd='rm -rf images')
+    # cleanup (deletion continues in background)
+    fsutil.trash(os.path.join(dragon.OUT_DIR, 'images'))
     manifest_path = os.path.join(dragon.OUT_DIR, 'manifest.xml')
     dragon.gen_manifest_xml(manifest_path)
     task.call_base_pre_hook(args)
@@ -398,35 +1081,68 @@ class App:
         self.apk_file = apk_file
 
 
-def _make_hook_images(symbols_path, apps, def_abi):
+def _make_hook_images(symbols_path, apps, def_abi, symbols_compression=None,
+                      symbol_store=None, delta_base=None):
     def _hook_images(task, args):
-        # tar symbols
-        symbols_file = os.path.join(dragon.OUT_DIR,
-                                    'symbols-{}-{}.tar'.format(
-                                        dragon.PRODUCT, dragon.VARIANT))
-        dragon.exec_cmd(cwd=symbols_path,
-                        cmd='find . -name "*.so" | tar -cv -f ' +
-                        symbols_file +
-                        ' --files-from -')
-
-        # link apk(s)
+        # checksums of the release files, computed as they are produced
+        sums = checksums.release_manifest()
+
+        # link apk(s), hashed while symbols are archived
         images_dir = os.path.join(dragon.OUT_DIR, 'images')
         dragon.makedirs(images_dir)
         for app in apps:
-            dragon.exec_cmd(cwd=images_dir,
-                            cmd='ln -s {} .'.format(app.apk_file))
+            apk_link = os.path.join(images_dir,
+                                    os.path.basename(app.apk_file))
+            fsutil.stage_symlink(app.apk_file, apk_link)
+            sums.add(apk_link)
+
+        symbols_name = 'symbols-{}-{}'.format(dragon.PRODUCT, dragon.VARIANT)
+        if symbol_store is not None:
+            # add new symbols to the store, only keep a manifest
+            manifest_file = os.path.join(dragon.OUT_DIR, '{}.manifest'.format(
+                symbols_name))
+            symbols.store_symbols(symbols_path, symbol_store, manifest_file,
+                                  jobs=dragon.OPTIONS.jobs.job_num)
+            sums.add(manifest_file)
+        else:
+            # tar symbols
+            symbols_file = os.path.join(dragon.OUT_DIR, '{}{}'.format(
+                symbols_name, archive.tar_ext(symbols_compression)))
+            symbols_index = os.path.join(
+                dragon.OUT_DIR, '{}-buildids.txt'.format(symbols_name))
+            if delta_base is not None:
+                # only the symbols not in the base release
+                job_num = dragon.OPTIONS.jobs.job_num
+                entries = symbols.scan(symbols_path, jobs=job_num)
+                symbols_file = delta.make_archive(
+                    [(relpath, os.path.join(symbols_path, relpath))
+                     for relpath, _ in entries],
+                    symbols_file, base_dir=delta_base,
+                    backend=symbols_compression, jobs=job_num)
+                symbols.write_index(symbols_index, entries)
+            else:
+                symbols.archive_symbols(symbols_path, symbols_file,
+                                        compression=symbols_compression,
+                                        jobs=dragon.OPTIONS.jobs.job_num,
+                                        index_file=symbols_index)
+            sums.add(symbols_file)
+            sums.add(symbols_index)
 
         # build.prop
         build_prop_file = os.path.join(dragon.OUT_DIR, def_abi,
                                        'staging', 'etc', 'build.prop')
-        dragon.exec_cmd(cwd=dragon.OUT_DIR,
-                        cmd='cp {} .'.format(build_prop_file))
+        fsutil.stage_file(build_prop_file,
+                          os.path.join(dragon.OUT_DIR, 'build.prop'))
+        sums.add(os.path.join(dragon.OUT_DIR, 'build.prop'))
 
         # global.config
         global_config_file = os.path.join(dragon.OUT_DIR, def_abi,
                                           'global.config')
-        dragon.exec_cmd(cwd=dragon.OUT_DIR,
-                        cmd='cp {} .'.format(global_config_file))
+        fsutil.stage_file(global_config_file,
+                          os.path.join(dragon.OUT_DIR, 'global.config'))
+        sums.add(os.path.join(dragon.OUT_DIR, 'global.config'))
+
+        sums.write()
 
         # next hooks
         task.call_base_exec_hook(args)
@@ -434,15 +1150,21 @@ def _make_hook_images(symbols_path, apps, def_abi):
 
 
 def add_release_task(symbols_path, apps, default_abi, *,
-                     extra_tasks=[], build_task='build'):
-    _init()
+                     extra_tasks=[], build_task='build',
+                     symbols_compression=None, symbol_store_dir=None,
+                     symbol_store_max_size=None, delta_base=None):
     if dragon.OPTIONS.android_abis:
         default_abi = dragon.OPTIONS.android_abis[0]
+    if getattr(dragon.OPTIONS, 'apps_tools_delta_base', None):
+        delta_base = dragon.OPTIONS.apps_tools_delta_base
 
     dragon.override_meta_task(
         name='images-all',
-        prehook=_hook_pre_images,
-        exechook=_make_hook_images(symbols_path, apps, default_abi)
+        prehook=trace.hook('pre-images', _hook_pre_images),
+        exechook=trace.hook('images', _make_hook_images(
+            symbols_path, apps, default_abi, symbols_compression,
+            store.Store(symbol_store_dir, symbol_store_max_size)
+            if symbol_store_dir else None, delta_base))
     )
 
     subtasks = [
@@ -452,7 +1174,15 @@ def add_release_task(symbols_path, apps, default_abi, *,
     subtasks.extend(extra_tasks)
     subtasks.append('gen-release-archive')
 
+    # Extra tasks are assumed to only need the build
+    deps = {build_task: [], 'images-all': [build_task]}
+    deps.update((extra, [build_task]) for extra in extra_tasks)
+    deps['gen-release-archive'] = ['images-all'] + extra_tasks
+    common.set_release_graph(deps)
+
     dragon.override_meta_task(
         name='release',
-        subtasks=subtasks
+        subtasks=subtasks,
+        prehook=common.start_release,
+        posthook=common.finish_release
     )
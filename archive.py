@@ -0,0 +1,140 @@
+# Packaging of release archives
+import concurrent.futures
+import collections
+import contextlib
+import os
+import shutil
+import subprocess
+import tarfile
+import zlib
+
+# tarfile: single threaded gzip (historical behaviour)
+# gzip: block parallel gzip, still a standard .tar.gz
+# zstd: multi-threaded zstd through the zstd command, produces a .tar.zst
+BACKENDS = ('tarfile', 'gzip', 'zstd')
+
+_EXTENSIONS = {
+    None: '.tar',
+    'tarfile': '.tar.gz',
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+
+def tar_ext(backend):
+    return _EXTENSIONS[backend]
+
+
+class ParallelGzipWriter:
+    # Write only file object compressing fixed size blocks concurrently.
+    # Each block is a complete gzip member, and a sequence of members is a
+    # valid gzip stream (RFC 1952) that gzip, tar and python all read.
+    # zlib releases the GIL while compressing, so threads are enough.
+
+    def __init__(self, fileobj, threads, *, block_size=4 << 20, level=6):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._level = level
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads)
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _submit(self, data):
+        self._pending.append(self._executor.submit(self._compress, data))
+        while len(self._pending) >= self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+
+
+@contextlib.contextmanager
+def open_tar(dest, *, backend=None, threads=1):
+    # Yield a tarfile writing to dest, compressed with backend (None for a
+    # plain tar). Members are streamed, nothing is kept in memory.
+    if backend is None:
+        with tarfile.open(dest, 'w') as tar:
+            yield tar
+    elif backend == 'tarfile':
+        with tarfile.open(dest, 'w:gz') as tar:
+            yield tar
+    elif backend == 'gzip':
+        with open(dest, 'wb') as f:
+            writer = ParallelGzipWriter(f, threads)
+            try:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    yield tar
+            finally:
+                writer.close()
+    elif backend == 'zstd':
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise RuntimeError('zstd not found, needed to make {}'.format(
+                dest))
+        proc = subprocess.Popen([zstd, '-q', '-f', '-T{}'.format(threads),
+                                 '-o', dest], stdin=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                yield tar
+        finally:
+            proc.stdin.close()
+            ret = proc.wait()
+        if ret != 0:
+            raise RuntimeError('zstd failed with status {}'.format(ret))
+    else:
+        raise ValueError('Unknown archive backend: {}'.format(backend))
+
+
+def make_tar(src_dir, name, dest, *, backend='tarfile', threads=1):
+    # Archive src_dir/name as name in dest. No chdir so that several
+    # archives can be made concurrently from threads.
+    with open_tar(dest, backend=backend, threads=threads) as tar:
+        tar.add(os.path.join(src_dir, name), arcname=name)
+
+
+@contextlib.contextmanager
+def read_tar(path):
+    # Yield a tarfile reading path as a stream, whatever its compression
+    if path.endswith(_EXTENSIONS['zstd']):
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise RuntimeError('zstd not found, needed to read {}'.format(
+                path))
+        proc = subprocess.Popen([zstd, '-q', '-d', '-c', path],
+                                stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                yield tar
+        finally:
+            proc.stdout.close()
+            proc.wait()
+    else:
+        with tarfile.open(path, 'r|*') as tar:
+            yield tar
+
+
+def backend_of(path):
+    # Backend writing archives like path (by extension)
+    if path.endswith(_EXTENSIONS['zstd']):
+        return 'zstd'
+    if path.endswith(_EXTENSIONS['gzip']):
+        return 'gzip'
+    return None
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Compare the xcarchive packaging backends on a synthetic archive tree
+import argparse
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import time
+
+import benchutil
+
+benchutil.setup_path()
+
+import apps_tools.archive as archive  # noqa: E402
+
+
+def gen_tree(root, *, files, size, seed=0):
+    # Half random (incompressible) payload like binaries, half text like
+    # plists and dSYM tables
+    rnd = random.Random(seed)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz')
+                   for _ in range(rnd.randint(3, 12))) for _ in range(512)]
+    for i in range(files):
+        path = os.path.join(root, 'Products', 'd{:03d}'.format(i % 32),
+                            'f{:05d}.bin'.format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if i % 2:
+                f.write(rnd.randbytes(size))
+            else:
+                data = bytearray()
+                while len(data) < size:
+                    data += rnd.choice(words) + b' '
+                f.write(bytes(data[:size]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare xcarchive packaging backends')
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256 << 10,
+                        help='size of each file in bytes')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--backends', nargs='+', default=archive.BACKENDS,
+                        choices=archive.BACKENDS)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-archive-')
+    try:
+        name = 'App.xcarchive'
+        gen_tree(os.path.join(workdir, name), files=args.files,
+                 size=args.size)
+        total = args.files * args.size
+        print('tree: {} files, {:.1f} MiB, {} threads'.format(
+            args.files, total / (1 << 20), args.threads))
+        ref = None
+        for backend in args.backends:
+            if backend == 'zstd' and not shutil.which('zstd'):
+                print('{:8s} skipped (zstd not found)'.format(backend))
+                continue
+            dest = os.path.join(workdir, 'out' + archive.tar_ext(backend))
+            start = time.monotonic()
+            archive.make_tar(workdir, name, dest, backend=backend,
+                             threads=args.threads)
+            elapsed = time.monotonic() - start
+            if backend != 'zstd':
+                with tarfile.open(dest, 'r:gz') as tar:
+                    assert len(tar.getnames()) > args.files
+            if backend == 'tarfile':
+                ref = elapsed
+            speedup = ' x{:.2f}'.format(ref / elapsed) if ref else ''
+            print('{:8s} {:7.2f}s {:7.1f} MiB/s ratio {:.3f}{}'.format(
+                backend, elapsed, total / elapsed / (1 << 20),
+                os.path.getsize(dest) / total, speedup))
+            os.unlink(dest)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
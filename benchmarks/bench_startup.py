@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Time the import of apps_tools and the registration of its tasks, as done
+# by a product buildext at dragon startup (before '-h' or any task runs).
+# ANDROID_NDK_PATH is removed from the environment: registration must not
+# need the NDK.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import benchutil
+
+
+def child(abis, apps):
+    start = time.perf_counter()
+    benchutil.setup_path(stub_dragon=True)
+    import apps_tools.buildext as buildext
+    buildext.setup_argparse(argparse.ArgumentParser())
+    buildext.setup_deftasks()
+
+    import apps_tools.android as android
+    android.add_task_build_common(abis)
+    android.add_ndk_build_task(name='build-jni', calldir='jni',
+                               module='jni', abis=abis)
+    android.add_gradle_task(name='build-app', calldir='app',
+                            target='assembleRelease', abis=abis)
+    android.add_release_task('symbols', [android.App('app.apk')], abis[0])
+
+    import apps_tools.ios as ios
+    ios.add_task_build_common()
+    ios.add_release_task(calldir='ios', workspace='App.xcworkspace',
+                         apps=[ios.App('Scheme{}'.format(i), 'Release',
+                                       'com.example.app{}'.format(i))
+                               for i in range(apps)])
+    print(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time apps_tools task registration')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--apps', type=int, default=4)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    abis = ['armeabi-v7a', 'arm64-v8a', 'x86', 'x86_64']
+    if args.child:
+        child(abis, args.apps)
+        return
+
+    env = dict(os.environ)
+    env.pop('ANDROID_NDK_PATH', None)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           '--apps', str(args.apps)]
+    times = []
+    for _ in range(args.runs):
+        out = subprocess.check_output(cmd, env=env)
+        times.append(float(out.decode().split()[-1]))
+    print('registration: min {:.2f} ms, median {:.2f} ms ({} runs)'.format(
+        min(times) * 1000, statistics.median(times) * 1000, args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# Shared setup of the benchmarks
+import os
+import sys
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def setup_path(*, stub_dragon=False):
+    # Make the apps_tools modules importable whatever the checkout name is,
+    # and optionally the stand-in dragon module
+    if 'apps_tools' not in sys.modules:
+        pkg = types.ModuleType('apps_tools')
+        pkg.__path__ = [ROOT_DIR]
+        sys.modules['apps_tools'] = pkg
+    if stub_dragon:
+        sys.path.insert(0, os.path.join(BENCH_DIR, 'stub'))
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# Benchmark suite of apps_tools: task registration, version computations,
+# the packaging of both images hooks on synthetic trees and sharded tests,
+# with the stand-in dragon module and tools of benchmarks/stub.
+#
+# Results can be saved as a JSON baseline and later runs compared with it:
+#   ./run.py --save baseline.json
+#   ./run.py --compare baseline.json --threshold 0.2
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+import benchutil
+
+STUB_BIN = os.path.join(benchutil.BENCH_DIR, 'stub', 'bin')
+
+
+def make_elf(path, build_id, size, rnd):
+    # Minimal ELF64 shared object with a GNU build-id note
+    note = struct.pack('<III', 4, len(build_id), 3) + b'GNU\0' + build_id
+    header = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+    header += struct.pack('<HHIQQQIHHHHHH', 3, 183, 1, 0, 64, 0, 0, 64, 56,
+                          1, 64, 0, 0)
+    phdr = struct.pack('<IIQQQQQQ', 4, 4, 120, 0, 0, len(note), len(note), 4)
+    with open(path, 'wb') as f:
+        f.write(header + phdr + note + rnd.randbytes(size))
+
+
+class Env:
+    # Synthetic workspace, NDK and outputs in a temporary directory
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(0)
+        self.root = tempfile.mkdtemp(prefix='apps-tools-bench-')
+        self.workspace = os.path.join(self.root, 'workspace')
+        self.ndk = os.path.join(self.root, 'ndk')
+        os.makedirs(os.path.join(self.ndk, 'wrap.sh'))
+        with open(os.path.join(self.ndk, 'source.properties'), 'w') as f:
+            f.write('Pkg.Desc = Android NDK\nPkg.Revision = 23.1.7779620\n')
+        shutil.copy(os.path.join(STUB_BIN, 'ndk-build'), self.ndk)
+        os.makedirs(os.path.join(self.workspace, 'app'))
+        shutil.copy(os.path.join(STUB_BIN, 'gradlew'),
+                    os.path.join(self.workspace, 'app'))
+        os.makedirs(os.path.join(self.workspace, 'jni'))
+        with open(os.path.join(self.workspace, 'jni', 'Android.mk'), 'w') as f:
+            f.write('# bench\n')
+        os.environ.update({
+            'BENCH_WORKSPACE_DIR': self.workspace,
+            'BENCH_OUT_ROOT_DIR': os.path.join(self.root, 'out'),
+            'ANDROID_NDK_PATH': self.ndk,
+            'XDG_CACHE_HOME': os.path.join(self.root, 'cache'),
+            'PATH': STUB_BIN + os.pathsep + os.environ['PATH'],
+        })
+        benchutil.setup_path(stub_dragon=True)
+        import dragon
+        self.dragon = dragon
+        dragon.OPTIONS.jobs.job_num = args.jobs
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+    def task(self, name):
+        dragon = self.dragon
+
+        class _Task:
+            def __init__(self):
+                self.name = name
+                self.extra_env = {}
+
+            def call_base_pre_hook(self, args):
+                pass
+
+            def call_base_exec_hook(self, args):
+                pass
+
+            def call_base_post_hook(self, args):
+                pass
+        return dragon.TASKS[name], _Task()
+
+    def run_hook(self, name, hook):
+        kwargs, task = self.task(name)
+        kwargs[hook](task, [])
+
+    def gen_symbols(self):
+        symbols = os.path.join(self.root, 'symbols')
+        if not os.path.exists(symbols):
+            for i in range(self.args.files):
+                path = os.path.join(symbols, 'obj', 'local',
+                                    'abi{}'.format(i % 4),
+                                    'libmod{:05d}.so'.format(i))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                make_elf(path, self.rnd.randbytes(20), self.args.size,
+                         self.rnd)
+        return symbols
+
+    def gen_archives(self, apps):
+        for app in apps:
+            path = app._archivePath(self.dragon.OUT_DIR)
+            if os.path.exists(path):
+                continue
+            for i in range(self.args.files // len(apps)):
+                fpath = os.path.join(path, 'dSYMs', 'f{:05d}'.format(i))
+                os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                with open(fpath, 'wb') as f:
+                    f.write(self.rnd.randbytes(self.args.size // 2) +
+                            bytes(self.args.size // 2))
+
+    def gen_staging(self, abi):
+        out = self.dragon.OUT_DIR
+        for base in (os.path.join(out, abi), out):
+            os.makedirs(os.path.join(base, 'staging', 'etc'), exist_ok=True)
+            for name in (os.path.join('staging', 'etc', 'build.prop'),
+                         'global.config'):
+                with open(os.path.join(base, name), 'w') as f:
+                    f.write('bench\n')
+
+
+def bench_register_android(env):
+    import apps_tools.android as android
+    abis = ['abi{}'.format(i) for i in range(env.args.abis)]
+
+    def run():
+        env.dragon.reset()
+        android.add_task_build_common(abis)
+    return run
+
+
+def bench_register_ios(env):
+    import apps_tools.ios as ios
+    apps = [ios.App('Scheme{}'.format(i), 'Release', 'com.bench{}'.format(i))
+            for i in range(env.args.apps)]
+
+    def run():
+        env.dragon.reset()
+        ios.add_release_task(calldir=env.workspace, workspace='B.xcworkspace',
+                             apps=apps)
+    return run
+
+
+def bench_version_code(env):
+    from apps_tools.common import get_version_code
+    versions = [env.dragon.Version('{}.{}.{}-rc{}'.format(i % 99, i % 37,
+                                                          i % 11, i % 7))
+                for i in range(1000)]
+
+    def run():
+        for version in versions:
+            get_version_code(version)
+            get_version_code(version, use_dots=True)
+    return run
+
+
+def bench_ndk_version(env):
+    import apps_tools.android as android
+    names = ['r{}{}'.format(major, letter) for major in range(10, 27)
+             for letter in ('', 'b', 'c', 'd')]
+
+    def run():
+        versions = [android._ndk_version(name) for name in names]
+        sorted(versions, key=lambda v: (v.major, v.minor))
+        for a in versions:
+            for b in versions[:8]:
+                _ = a < b, a >= b, a == b
+    return run
+
+
+def bench_ndk_build_task(env):
+    import apps_tools.android as android
+
+    def run():
+        env.dragon.reset()
+        android.add_ndk_build_task(name='build-jni',
+                                   calldir=os.path.join(env.workspace, 'jni'),
+                                   module='bench',
+                                   abis=['arm64-v8a', 'x86_64'])
+        env.run_hook('build-jni', 'posthook')
+    return run
+
+
+def bench_gradle_task(env):
+    import apps_tools.android as android
+
+    def run():
+        env.dragon.reset()
+        android.add_gradle_task(name='build-app',
+                                calldir=os.path.join(env.workspace, 'app'),
+                                target='assembleRelease')
+        env.run_hook('build-app', 'posthook')
+    return run
+
+
+def bench_images_android(env):
+    import apps_tools.android as android
+    symbols = env.gen_symbols()
+    env.gen_staging('arm64-v8a')
+    apk = os.path.join(env.root, 'bench.apk')
+    with open(apk, 'w') as f:
+        f.write('apk\n')
+
+    def run():
+        env.dragon.reset()
+        android.add_release_task(symbols, [android.App(apk)], 'arm64-v8a')
+        env.run_hook('images-all', 'prehook')
+        env.run_hook('images-all', 'exechook')
+    return run
+
+
+def bench_images_ios(env):
+    import apps_tools.ios as ios
+    signing = ios.SignatureInfos('bench', 'TEAM', 'profile')
+    apps = [ios.App('Scheme{}'.format(i), 'Release', 'com.bench{}'.format(i),
+                    inhouse_infos=signing, display_name='Scheme{}'.format(i))
+            for i in range(env.args.apps)]
+    env.gen_archives(apps)
+    env.gen_staging('')
+
+    def run():
+        env.dragon.reset()
+        ios.add_release_task(calldir=env.workspace, workspace='B.xcworkspace',
+                             apps=apps)
+        env.run_hook('images-all', 'prehook')
+        env.run_hook('images-all', 'exechook')
+    return run
+
+
+def bench_archives_parallel(env):
+    import apps_tools.ios as ios
+    apps = [ios.App('Par{}'.format(i), 'Release', 'com.par{}'.format(i))
+            for i in range(env.args.apps)]
+    os.environ['BENCH_XCODEBUILD_DELAY'] = '0.05'
+
+    def run():
+        env.dragon.reset()
+        ios.add_release_task(calldir=env.workspace, workspace='B.xcworkspace',
+                             apps=apps, parallel_archives=env.args.apps)
+        env.run_hook('build-archives', 'posthook')
+    return run
+
+
+def bench_xctool_shards(env):
+    import apps_tools.ios as ios
+    classes = ['Test{:02d}'.format(i) for i in range(env.args.tests)]
+    os.environ['BENCH_XCTOOL_CLASSES'] = ' '.join(classes)
+    destinations = ['platform=iOS Simulator,name=Bench {}'.format(idx)
+                    for idx in range(env.args.shards)]
+
+    def run():
+        env.dragon.reset()
+        ios.add_xctool_task(calldir=env.workspace, workspace='B.xcworkspace',
+                            configuration='Debug', scheme='Bench',
+                            action='run-tests', name='test-bench',
+                            reporter='junit:{}'.format(os.path.join(
+                                env.root, 'test-bench.xml')),
+                            shards=env.args.shards, test_target='BenchTests',
+                            destinations=destinations)
+        env.run_hook('test-bench', 'posthook')
+    return run
+
+
+BENCHMARKS = {
+    'register_android': bench_register_android,
+    'register_ios': bench_register_ios,
+    'version_code': bench_version_code,
+    'ndk_version': bench_ndk_version,
+    'ndk_build_task': bench_ndk_build_task,
+    'gradle_task': bench_gradle_task,
+    'images_android': bench_images_android,
+    'images_ios': bench_images_ios,
+    'archives_parallel': bench_archives_parallel,
+    'xctool_shards': bench_xctool_shards,
+}
+
+
+def measure(func, repeat):
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def compare(results, baseline, threshold):
+    # Return the names of the benchmarks slower than baseline by more than
+    # threshold (a ratio)
+    regressions = []
+    print('{:<20} {:>12} {:>12} {:>8}'.format('benchmark', 'time', 'baseline',
+                                             'delta'))
+    for name, value in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            print('{:<20} {:>10.3f}ms {:>12} {:>8}'.format(name, value * 1000,
+                                                          '-', '-'))
+            continue
+        delta = (value - ref) / ref if ref else 0.0
+        flag = ''
+        if delta > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{:<20} {:>10.3f}ms {:>10.3f}ms {:>+7.1%}{}'.format(
+            name, value * 1000, ref * 1000, delta, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='apps_tools benchmarks')
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='benchmarks to run (all by default)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--abis', type=int, default=32,
+                        help='number of ABIs to register')
+    parser.add_argument('--apps', type=int, default=8,
+                        help='number of iOS apps')
+    parser.add_argument('--tests', type=int, default=24,
+                        help='number of test classes of xctool_shards')
+    parser.add_argument('--shards', type=int, default=4,
+                        help='number of xctool shards')
+    parser.add_argument('--files', type=int, default=400,
+                        help='files in synthetic symbols/archive trees')
+    parser.add_argument('--size', type=int, default=64 << 10,
+                        help='size of synthetic files in bytes')
+    parser.add_argument('--save', metavar='JSON',
+                        help='save results as a baseline')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='compare results with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+
+    env = Env(args)
+    results = {}
+    try:
+        for name in args.names or BENCHMARKS:
+            results[name] = measure(BENCHMARKS[name](env), args.repeat)
+    finally:
+        env.cleanup()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': {k: v for k, v in vars(args).items()
+                                  if k in ('repeat', 'jobs', 'abis', 'apps',
+                                           'tests', 'shards', 'files',
+                                           'size')},
+                       'results': results}, f, indent=2)
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# Minimal stand-in for the dragon build system, enough to import apps_tools,
+# register its tasks and run its hooks outside of a workspace.
+# Directories come from the BENCH_* environment variables.
+import logging
+import os
+import subprocess
+import types
+
+
+class ExecError(Exception):
+    pass
+
+
+class TaskError(Exception):
+    pass
+
+
+class TaskExit(Exception):
+    pass
+
+
+class SetupError(Exception):
+    pass
+
+
+WORKSPACE_DIR = os.environ.get('BENCH_WORKSPACE_DIR', os.getcwd())
+OUT_ROOT_DIR = os.environ.get('BENCH_OUT_ROOT_DIR',
+                              os.path.join(WORKSPACE_DIR, 'out'))
+PRODUCT = 'product'
+VARIANT = 'variant'
+OUT_DIR = os.path.join(OUT_ROOT_DIR, '{}-{}'.format(PRODUCT, VARIANT))
+ALCHEMY_HOME = os.path.join(WORKSPACE_DIR, 'build', 'alchemy')
+
+OPTIONS = types.SimpleNamespace(
+    jobs=types.SimpleNamespace(job_num=os.cpu_count()),
+    verbose=False,
+    dryrun=False,
+    android_abis=None,
+    android_parallel_common=False,
+    android_compiler_cache=None,
+    android_ndk_fan_out=False,
+    android_artifact_cache=None,
+    android_gradle_performance=False,
+    ios_parallel_archives=None,
+    ios_xctool_shards=None,
+    apps_tools_delta_base=None,
+    apps_tools_jobserver=True,
+    apps_tools_log_capture=None,
+    apps_tools_memory_guard=False,
+)
+
+LOGI = logging.info
+LOGW = logging.warning
+LOGE = logging.error
+LOGD = logging.debug
+
+# name -> registration keyword arguments
+TASKS = {}
+ALCHEMY_VARS = {}
+
+
+def reset():
+    TASKS.clear()
+
+
+def add_meta_task(**kwargs):
+    TASKS[kwargs['name']] = kwargs
+
+
+def add_alchemy_task(**kwargs):
+    TASKS[kwargs['name']] = kwargs
+
+
+def override_meta_task(**kwargs):
+    TASKS.setdefault(kwargs['name'], {}).update(kwargs)
+
+
+def override_alchemy_task(name, **kwargs):
+    TASKS.setdefault(name, {}).update(kwargs)
+
+
+def get_alchemy_var(name):
+    return ALCHEMY_VARS.get(name)
+
+
+def exec_cmd(cmd, cwd=None, extra_env=None, dryrun=None):
+    env = dict(os.environ)
+    env.update(extra_env or {})
+    ret = subprocess.call(cmd, shell=True, cwd=cwd, env=env,
+                          executable='/bin/bash')
+    if ret != 0:
+        raise ExecError('Command failed ({}): {}'.format(ret, cmd))
+
+
+def makedirs(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def gen_manifest_xml(path):
+    with open(path, 'w') as f:
+        f.write('<manifest/>\n')
+
+
+class Version:
+    TYPE_ALPHA = 0
+    TYPE_BETA = 1
+    TYPE_RC = 2
+    TYPE_RELEASE = 3
+
+    _TYPE_NAMES = {TYPE_ALPHA: 'alpha', TYPE_BETA: 'beta', TYPE_RC: 'rc'}
+
+    def __init__(self, version):
+        base, _, suffix = version.partition('-')
+        self.major, self.minor, self.patch = (int(x) for x in base.split('.'))
+        self.type = Version.TYPE_RELEASE
+        self.build = 0
+        for type_, name in Version._TYPE_NAMES.items():
+            if suffix.startswith(name):
+                self.type = type_
+                self.build = int(suffix[len(name):] or 0)
+        self.custom = None
+        self.custom_number = 0
+        self.type_string = None
+
+    def __str__(self):
+        version = '{}.{}.{}'.format(self.major, self.minor, self.patch)
+        if self.type != Version.TYPE_RELEASE:
+            version += '-{}{}'.format(Version._TYPE_NAMES[self.type],
+                                      self.build)
+        return version
+
+
+PARROT_BUILD_VERSION = Version('1.2.3-beta4')
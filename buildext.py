@@ -1,12 +1,27 @@
 # Common things
 
 import dragon
-import apps_tools.android as android
 from apps_tools.common import get_version_code
 
 
 def setup_argparse(parser):
+    # Options of all the modules, so the platform modules are imported here
+    # (not when buildext is imported)
+    import apps_tools.android as android
+    import apps_tools.common as common
+    import apps_tools.delta as delta
+    import apps_tools.ios as ios
+    import apps_tools.jobserver as jobserver
+    import apps_tools.logcapture as logcapture
+    import apps_tools.pressure as pressure
+    # Recorded to be given to child dragon instances
+    parser = common.OptionRecorder(parser)
     android.setup_argparse(parser)
+    delta.setup_argparse(parser)
+    ios.setup_argparse(parser)
+    jobserver.setup_argparse(parser)
+    logcapture.setup_argparse(parser)
+    pressure.setup_argparse(parser)
 
 def setup_deftasks():
     # Do additional checks on version code early to avoid useless builds
@@ -0,0 +1,71 @@
+# Checksum manifest of release artifacts (OUT_DIR/SHA256SUMS, the format of
+# sha256sum, paths relative to OUT_DIR). Artifacts are hashed in background
+# threads as soon as they are produced, so that hashing overlaps with the
+# compression and export of the next ones.
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+
+import dragon
+
+import apps_tools.trace as trace
+
+MANIFEST_NAME = 'SHA256SUMS'
+
+
+def sha256_file(path):
+    # Hex sha256 of a file, read through a memory map (no copy, and the
+    # GIL is released while hashing so threads hash files concurrently)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest.hexdigest()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mm)
+        except (OSError, ValueError):
+            # Not mappable (special file system)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    def __init__(self, root, *, jobs=1):
+        self.root = root
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs, thread_name_prefix='checksums')
+        self._futures = {}
+
+    def add(self, path):
+        # Hash path (a symlink is hashed as its target) in the background
+        name = os.path.relpath(path, self.root)
+        self._futures[name] = self._executor.submit(
+            sha256_file, os.path.realpath(path))
+
+    def write(self, path=None):
+        # Wait for the pending hashes and write the manifest. Return its
+        # path.
+        if path is None:
+            path = os.path.join(self.root, MANIFEST_NAME)
+        with trace.span('checksums', files=len(self._futures)):
+            lines = ['{}  {}\n'.format(future.result(), name)
+                     for name, future in sorted(self._futures.items())]
+            self._executor.shutdown()
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp, path)
+        logging.info('Checksums of %d release files in %s', len(lines),
+                     path)
+        return path
+
+
+def release_manifest():
+    # Manifest of the artifacts of a release in OUT_DIR
+    return Manifest(dragon.OUT_DIR, jobs=dragon.OPTIONS.jobs.job_num)
@@ -1,5 +1,20 @@
+import atexit
+import concurrent.futures
+import logging
+import os
+import queue
+import shlex
+import threading
+import time
 import dragon
 
+import apps_tools.compiler_cache as compiler_cache
+import apps_tools.critpath as critpath
+import apps_tools.fsutil as fsutil
+import apps_tools.jobserver as jobserver
+import apps_tools.logcapture as logcapture
+import apps_tools.trace as trace
+
 
 def get_version_code(version, *, use_dots=False):
     if version.major == 0 and version.minor == 0 and version.patch == 0:
@@ -25,3 +40,226 @@ def get_version_code(version, *, use_dots=False):
         code = "{:02d}{:02d}{:02d}.{:01d}.{:02d}".format(version.major, version.minor, version.patch,
                                                          variant_codes[version.type], version.build)
     return code.lstrip("0")
+
+
+def exec_cmd(cmd, cwd=None, *, name=None, log_file=None, display=None,
+             capture=True):
+    # All commands of apps_tools go through here to be traced. Output goes
+    # to log_file if given. With log capture enabled (and capture true, not
+    # for interactive commands), output goes to a compressed log instead,
+    # the terminal getting only what the display filter makes of it.
+    if name is None:
+        name = os.path.basename(cmd.split(None, 1)[0])
+    with trace.span(name, cat='cmd', cmd=cmd):
+        if capture and logcapture.enabled():
+            logcapture.run(cmd, cwd, name=name, log_file=log_file,
+                           display=display)
+        elif log_file:
+            dragon.exec_cmd(cmd='({}) > {} 2>&1'.format(cmd, log_file),
+                            cwd=cwd)
+        else:
+            dragon.exec_cmd(cmd=cmd, cwd=cwd)
+
+
+def set_release_graph(deps):
+    # Record the dependencies between the subtasks of the release (a dict
+    # in execution order) for the critical path analysis, and register the
+    # task running it on the trace of the last release
+    trace.set_metadata('release', {'tasks': list(deps), 'deps': deps})
+    dragon.add_meta_task(
+        name='release-report',
+        desc='Critical path analysis of the last release',
+        posthook=lambda task, args: _release_report(),
+        secondary_help=True
+    )
+
+
+def _release_report():
+    trace_file = os.path.join(dragon.OUT_DIR, 'trace-release.json')
+    if not os.path.exists(trace_file):
+        raise dragon.TaskError('No release trace in {}'.format(trace_file))
+    for line in critpath.report(*critpath.load(trace_file)):
+        logging.info(line)
+
+
+def start_release(task, args):
+    trace.mark('release:start')
+    # The trace of a failed release is written at exit, finish_release not
+    # being called
+    atexit.register(_end_release, 'failed')
+    task.call_base_pre_hook(args)
+
+
+def finish_release(task, args):
+    atexit.unregister(_end_release)
+    try:
+        task.call_base_post_hook(args)
+    except BaseException:
+        _end_release('failed')
+        raise
+    _end_release('end')
+
+
+def _end_release(status):
+    # Wait for background deletions, stop the compiler cache servers and
+    # save the trace of the release
+    trace.mark('release:{}'.format(status))
+    fsutil.reap_trash()
+    compiler_cache.stop_servers()
+    trace_file = os.path.join(dragon.OUT_DIR, 'trace-release.json')
+    trace.write(trace_file)
+    for line in trace.summary():
+        logging.info(line)
+    logging.info('Trace of the release saved in %s', trace_file)
+
+
+# argparse actions of the apps_tools options (see buildext.setup_argparse)
+_OPTION_ACTIONS = []
+
+
+class OptionRecorder:
+    # Parser proxy recording the options added through it, so that they can
+    # be given to child dragon instances (see forwarded_options)
+    def __init__(self, parser):
+        self._parser = parser
+
+    def add_argument(self, *args, **kwargs):
+        action = self._parser.add_argument(*args, **kwargs)
+        _OPTION_ACTIONS.append(action)
+        return action
+
+
+def forwarded_options(*, exclude=()):
+    # Command line arguments giving a child dragon instance the verbosity
+    # and the apps_tools options of this one, but for the dests in exclude
+    args = ['-v'] if dragon.OPTIONS.verbose else []
+    for action in _OPTION_ACTIONS:
+        if action.dest in exclude:
+            continue
+        value = getattr(dragon.OPTIONS, action.dest, action.default)
+        if value == action.default:
+            continue
+        flag = action.option_strings[-1]
+        if action.nargs == 0:
+            args.append(flag)
+        elif isinstance(value, (list, tuple)):
+            args.append(flag)
+            args.extend(str(item) for item in value)
+        elif action.nargs == '?' and value == action.const:
+            args.append(flag)
+        else:
+            args.extend([flag, str(value)])
+    return ' '.join(shlex.quote(arg) for arg in args)
+
+
+def split_jobs(job_num, count):
+    # Share a -j budget between count concurrent commands (at least 1 each)
+    base, extra = divmod(max(job_num, count), count)
+    return [base + 1 if i < extra else base for i in range(count)]
+
+
+def exec_cmds_parallel(cmds, *, max_workers=None, jobs=None, check=True):
+    # Run (name, cmd, cwd, log_file) entries concurrently, output of each
+    # command going to its own log file. All commands are waited for before
+    # reporting failures so that one failure does not hide the others.
+    # With jobs (a -j budget per command), each command first takes up to
+    # its budget of jobserver slots, cmd being then a function of the
+    # number of jobs returning the command. With check false, the names of
+    # the failed commands are returned instead of raising.
+    if not cmds:
+        return []
+    if logcapture.enabled():
+        cmds = [(name, cmd, cwd, logcapture.log_path(name, log_file))
+                for name, cmd, cwd, log_file in cmds]
+
+    def _exec(name, cmd, cwd, log_file):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        logging.info('%s: started, log in %s', name, log_file)
+        start = time.monotonic()
+        exec_cmd(cmd, cwd=cwd, name=name, log_file=log_file)
+        logging.info('%s: done in %.1fs', name, time.monotonic() - start)
+
+    def _run(name, cmd, cwd, log_file, job_num):
+        if job_num is None:
+            _exec(name, cmd, cwd, log_file)
+            return
+        with jobserver.slots(job_num) as slots:
+            _exec(name, cmd(slots or job_num), cwd, log_file)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(cmds)) as executor:
+        futures = {}
+        for idx, entry in enumerate(cmds):
+            job_num = jobs[idx] if jobs else None
+            futures[executor.submit(_run, *entry, job_num)] = entry
+        for future in concurrent.futures.as_completed(futures):
+            name, _, _, log_file = futures[future]
+            try:
+                future.result()
+            except dragon.ExecError:
+                logging.error('%s: failed, see %s', name, log_file)
+                failed.append(name)
+    if failed and check:
+        raise dragon.ExecError('Failed: {}'.format(', '.join(sorted(failed))))
+    return sorted(failed)
+
+
+_PIPELINE_END = object()
+
+
+def run_pipeline(items, stages, *, maxsize=1):
+    # Pass items through stages, a list of (func, workers), the result of a
+    # stage being the input of the next one. Stages run concurrently, an
+    # item entering a stage while the previous one is in the next stage.
+    # Queues between stages hold at most maxsize items. The first error
+    # stops the pipeline (items in flight are dropped) and is raised once
+    # all workers are done.
+    queues = [queue.Queue(maxsize=maxsize) for _ in stages]
+    stop = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    remaining = [workers for _, workers in stages]
+
+    def _worker(idx, func):
+        inq = queues[idx]
+        outq = queues[idx + 1] if idx + 1 < len(queues) else None
+        while True:
+            item = inq.get()
+            if item is _PIPELINE_END:
+                inq.put(_PIPELINE_END)
+                break
+            if stop.is_set():
+                continue
+            try:
+                result = func(item)
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+                stop.set()
+                continue
+            if outq is not None:
+                outq.put(result)
+        with lock:
+            remaining[idx] -= 1
+            last = remaining[idx] == 0
+        if last and outq is not None:
+            outq.put(_PIPELINE_END)
+
+    threads = []
+    for idx, (func, workers) in enumerate(stages):
+        for _ in range(workers):
+            thread = threading.Thread(target=_worker, args=(idx, func))
+            thread.start()
+            threads.append(thread)
+    try:
+        for item in items:
+            if stop.is_set():
+                break
+            queues[0].put(item)
+    finally:
+        queues[0].put(_PIPELINE_END)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
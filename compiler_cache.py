@@ -0,0 +1,161 @@
+# Compiler cache (ccache or sccache) of the native builds, in a local
+# directory per NDK version and ABI:
+#   $APPS_TOOLS_CCACHE_DIR (default $XDG_CACHE_HOME/apps_tools) /
+#       <tool>/<ndk version>/<abi>
+# limited to $APPS_TOOLS_CCACHE_SIZE (default 5G).
+import fcntl
+import json
+import logging
+import os
+import shutil
+import subprocess
+import zlib
+
+TOOLS = ('ccache', 'sccache')
+
+DEFAULT_SIZE = '5G'
+
+# Ports of the sccache servers
+_PORT_BASE = 4300
+_PORT_COUNT = 700
+
+# sccache caches used, by directory: their servers are stopped at the end
+# of the release (see stop_servers)
+_SERVERS = {}
+
+
+def _cache_root():
+    root = os.environ.get('APPS_TOOLS_CCACHE_DIR')
+    if root:
+        return root
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'apps_tools')
+
+
+def _server_port(cache_dir):
+    # Port of the sccache server of cache_dir. Ports are recorded in the
+    # cache root (shared by all builds, concurrent ones included) for two
+    # directories to never get the same one.
+    ports_file = os.path.join(_cache_root(), 'sccache', 'ports.json')
+    os.makedirs(os.path.dirname(ports_file), exist_ok=True)
+    with open('{}.lock'.format(ports_file), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(ports_file, 'r') as f:
+                ports = json.load(f)
+        except (OSError, ValueError):
+            ports = {}
+        if cache_dir in ports:
+            return ports[cache_dir]
+        used = set(ports.values())
+        offset = zlib.crc32(cache_dir.encode()) % _PORT_COUNT
+        for idx in range(_PORT_COUNT):
+            port = _PORT_BASE + (offset + idx) % _PORT_COUNT
+            if port not in used:
+                break
+        else:
+            logging.warning('No free sccache server port for %s', cache_dir)
+        ports[cache_dir] = port
+        tmp = '{}.tmp'.format(ports_file)
+        with open(tmp, 'w') as f:
+            json.dump(ports, f, indent=1, sort_keys=True)
+        os.replace(tmp, ports_file)
+        return port
+
+
+class CompilerCache:
+    def __init__(self, tool, ndk_version, abi):
+        self.tool = tool
+        self.path = shutil.which(tool)
+        self.cache_dir = os.path.join(_cache_root(), tool, str(ndk_version),
+                                      abi)
+        self.size = os.environ.get('APPS_TOOLS_CCACHE_SIZE', DEFAULT_SIZE)
+        # The sccache server reads its configuration when it starts: use a
+        # server per cache directory
+        self.port = None
+        if tool == 'sccache':
+            self.port = _server_port(self.cache_dir)
+
+    def env(self):
+        # Environment of the compiler cache, local only
+        if self.tool == 'ccache':
+            return {
+                'CCACHE_DIR': self.cache_dir,
+                'CCACHE_MAXSIZE': self.size,
+            }
+        return {
+            'SCCACHE_DIR': self.cache_dir,
+            'SCCACHE_CACHE_SIZE': self.size,
+            'SCCACHE_SERVER_PORT': str(self.port),
+        }
+
+    def ndk_env(self):
+        # ndk-build prefixes the compiler with NDK_CCACHE
+        return dict(self.env(), NDK_CCACHE=self.path)
+
+    def stats(self):
+        # (hits, misses) counters of the cache, None if unknown
+        env = dict(os.environ, **self.env())
+        try:
+            if self.tool == 'ccache':
+                output = subprocess.check_output(
+                    [self.path, '--print-stats'], env=env,
+                    stderr=subprocess.DEVNULL, universal_newlines=True)
+                counters = dict(line.split('\t', 1)
+                                for line in output.splitlines()
+                                if '\t' in line)
+                hits = (int(counters.get('direct_cache_hit', 0)) +
+                        int(counters.get('preprocessed_cache_hit', 0)))
+                return hits, int(counters.get('cache_miss', 0))
+            output = subprocess.check_output(
+                [self.path, '--show-stats', '--stats-format', 'json'],
+                env=env, stderr=subprocess.DEVNULL, universal_newlines=True)
+            stats = json.loads(output)['stats']
+            return (sum(stats['cache_hits']['counts'].values()),
+                    sum(stats['cache_misses']['counts'].values()))
+        except (OSError, ValueError, KeyError, subprocess.CalledProcessError):
+            return None
+
+
+def enabled(tool):
+    return bool(tool) and tool != 'none'
+
+
+def get(tool, ndk_version, abi):
+    # Compiler cache of a native build for abi, None if disabled or not
+    # installed
+    if not enabled(tool):
+        return None
+    cache = CompilerCache(tool, ndk_version, abi)
+    if cache.path is None:
+        logging.warning('%s not found, building without compiler cache',
+                        tool)
+        return None
+    os.makedirs(cache.cache_dir, exist_ok=True)
+    if tool == 'sccache':
+        _SERVERS[cache.cache_dir] = cache
+    return cache
+
+
+def stop_servers():
+    # Stop the sccache servers of the caches used, instead of leaving them
+    # until their idle timeout
+    for cache in _SERVERS.values():
+        subprocess.call([cache.path, '--stop-server'],
+                        env=dict(os.environ, **cache.env()),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+    _SERVERS.clear()
+
+
+def report(name, cache, before, after):
+    # Log the hits and misses between two stats of cache, return them as
+    # a dict (empty if unknown)
+    if before is None or after is None:
+        return {}
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    total = hits + misses
+    logging.info('%s: %s %d hits, %d misses (%.0f%%)', name, cache.tool,
+                 hits, misses, 100.0 * hits / total if total else 0.0)
+    return {'cache_hits': hits, 'cache_misses': misses}
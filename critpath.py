@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Critical path analysis of a release from its trace (see trace.py and
+# common.finish_release). The release graph recorded in the trace gives
+# the dependencies between its subtasks, the spans give their durations.
+import argparse
+import json
+import sys
+
+_DEFAULT_JOBS = (1, 2, 4, 8, 16)
+
+
+def _task_of(span_name, tasks):
+    # Spans of hooks are named '<task>:<hook>', commands run concurrently
+    # by a task are named after the sub task they stand for
+    name = span_name.split(':', 1)[0]
+    return name if name in tasks else None
+
+
+def load(trace_file):
+    # Return (tasks in execution order, {task: deps}, {task: seconds})
+    with open(trace_file, 'r') as f:
+        data = json.load(f)
+    graph = data.get('otherData', {}).get('release')
+    if not graph:
+        raise ValueError('No release graph in {}'.format(trace_file))
+    tasks = graph['tasks']
+    deps = {task: graph['deps'].get(task, []) for task in tasks}
+
+    start = end = None
+    intervals = {}
+    for event in data['traceEvents']:
+        if event['ph'] == 'i' and event['name'] == 'release:start':
+            start = event['ts']
+        elif event['ph'] == 'i' and event['name'] in ('release:end',
+                                                      'release:failed'):
+            end = event['ts']
+        elif event['ph'] == 'X':
+            task = _task_of(event['name'], tasks)
+            if task is None:
+                continue
+            begin, finish = event['ts'], event['ts'] + event['dur']
+            if task in intervals:
+                begin = min(begin, intervals[task][0])
+                finish = max(finish, intervals[task][1])
+            intervals[task] = (begin, finish)
+
+    # Subtasks run one after the other: a task without spans took the time
+    # between its neighbours (shared by consecutive tasks without spans)
+    durations = {}
+    missing = []
+    prev_end = start
+    for task in tasks + [None]:
+        if task is not None and task not in intervals:
+            missing.append(task)
+            continue
+        next_start = intervals[task][0] if task is not None else end
+        if missing:
+            gap = 0
+            if prev_end is not None and next_start is not None:
+                gap = max(0, next_start - prev_end) / len(missing)
+            for name in missing:
+                durations[name] = gap / 1e6
+            missing = []
+        if task is not None:
+            durations[task] = (intervals[task][1] - intervals[task][0]) / 1e6
+            prev_end = intervals[task][1]
+    return tasks, deps, durations
+
+
+def analyze(tasks, deps, durations):
+    # Return ({task: (earliest start, latest start)}, critical path)
+    earliest = {}
+    for task in tasks:
+        earliest[task] = max((earliest[d] + durations[d]
+                              for d in deps[task]), default=0.0)
+    length = max((earliest[t] + durations[t] for t in tasks), default=0.0)
+    latest = {}
+    for task in reversed(tasks):
+        succs = [t for t in tasks if task in deps[t]]
+        latest[task] = min((latest[s] for s in succs),
+                           default=length) - durations[task]
+    path = []
+    task = max(tasks, key=lambda t: earliest[t] + durations[t], default=None)
+    while task is not None:
+        path.append(task)
+        task = next((d for d in deps[task]
+                     if abs(earliest[d] + durations[d] - earliest[task])
+                     < 1e-6), None)
+    return ({t: (earliest[t], latest[t]) for t in tasks},
+            list(reversed(path)))
+
+
+def simulate(tasks, deps, durations, workers):
+    # Makespan of a list scheduling with a number of concurrent tasks,
+    # longest remaining path first
+    bottom = {}
+    for task in reversed(tasks):
+        succs = [t for t in tasks if task in deps[t]]
+        bottom[task] = durations[task] + max((bottom[s] for s in succs),
+                                             default=0.0)
+    done = {}
+    running = []
+    now = 0.0
+    pending = list(tasks)
+    while pending or running:
+        ready = sorted((t for t in pending
+                        if all(d in done for d in deps[t])),
+                       key=lambda t: -bottom[t])
+        for task in ready[:workers - len(running)]:
+            pending.remove(task)
+            running.append((now + durations[task], task))
+        if not running:
+            raise ValueError('Dependency cycle in release graph')
+        running.sort()
+        now, task = running.pop(0)
+        done[task] = now
+    return now
+
+
+def report(tasks, deps, durations, jobs=_DEFAULT_JOBS):
+    times, path = analyze(tasks, deps, durations)
+    serial = sum(durations.values())
+    length = sum(durations[t] for t in path)
+    lines = ['{:<40} {:>9} {:>9} {:>9}'.format('task', 'time(s)',
+                                               'start(s)', 'slack(s)')]
+    for task in tasks:
+        start, latest = times[task]
+        lines.append('{:<40} {:>9.2f} {:>9.2f} {:>9.2f}{}'.format(
+            task[:40], durations[task], start, latest - start,
+            ' *' if task in path else ''))
+    lines.append('')
+    lines.append('critical path (*): {}'.format(' -> '.join(path)))
+    lines.append('sequential: {:.2f}s, critical path: {:.2f}s'.format(
+        serial, length))
+    for workers in jobs:
+        makespan = simulate(tasks, deps, durations, workers)
+        lines.append('{:>3} concurrent tasks: {:8.2f}s, speedup x{:.2f}'
+                     .format(workers, makespan,
+                             serial / makespan if makespan else 1.0))
+    lines.append('max speedup: x{:.2f}'.format(
+        serial / length if length else 1.0))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Critical path of a release from its trace')
+    parser.add_argument('trace_file',
+                        help='trace-release.json from the release OUT_DIR')
+    parser.add_argument('-j', '--jobs', type=int, nargs='+',
+                        default=_DEFAULT_JOBS,
+                        help='numbers of concurrent tasks to estimate')
+    args = parser.parse_args(argv)
+    for line in report(*load(args.trace_file), jobs=args.jobs):
+        print(line)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
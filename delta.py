@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Delta release archives. Next to each archive is written a manifest of its
+# content (<name>.hashes: type, mode and sha256 of every entry). When the
+# manifest of the previous release is found in the delta base directory,
+# only a delta archive (<name>.delta.tar.*) is written instead of the full
+# one: the new manifest and the files whose content the previous release
+# did not have. The full archive is rebuilt from the previous one and the
+# delta with:
+#   python3 -m apps_tools.delta <base archive> <delta archive> <output>
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import logging
+import os
+import stat
+import sys
+import tarfile
+import tempfile
+
+import apps_tools.archive as archive
+import apps_tools.checksums as checksums
+
+MANIFEST_EXT = '.hashes'
+
+# Description of the delta in the delta archive (first member)
+_DELTA_INFO = 'DELTA.json'
+_OBJECTS_DIR = 'objects'
+
+
+def tree_entries(src_dir, name):
+    # (arcname, path) of src_dir/name and everything below, parents first
+    # (symlinks are not followed)
+    top = os.path.join(src_dir, name)
+    entries = [(name, top)]
+    if os.path.islink(top) or not os.path.isdir(top):
+        return entries
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        arcdir = os.path.join(name, os.path.relpath(dirpath, top))
+        for entry in sorted(dirnames + filenames):
+            entries.append((os.path.normpath(os.path.join(arcdir, entry)),
+                            os.path.join(dirpath, entry)))
+    return entries
+
+
+def make_manifest(entries, *, jobs=1):
+    # Manifest entries of (arcname, path) entries, files hashed concurrently
+    def _entry(item):
+        arcname, path = item
+        st = os.lstat(path)
+        entry = {'path': arcname, 'mode': stat.S_IMODE(st.st_mode),
+                 'mtime': int(st.st_mtime)}
+        if stat.S_ISLNK(st.st_mode):
+            entry.update(type='link', target=os.readlink(path))
+        elif stat.S_ISDIR(st.st_mode):
+            entry.update(type='dir')
+        else:
+            entry.update(type='file', size=st.st_size,
+                         sha256=checksums.sha256_file(path))
+        return entry
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_entry, entries))
+
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)['entries']
+
+
+def _save_manifest(path, manifest):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump({'entries': manifest}, f, indent=0)
+    os.replace(tmp, path)
+
+
+def _stem(dest):
+    # Name of an archive without its tar extension
+    name = os.path.basename(dest)
+    for ext in ('.tar.gz', '.tar.zst', '.tar'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def delta_path(dest):
+    # <name>.tar.gz -> <name>.delta.tar.gz
+    stem = _stem(dest)
+    ext = os.path.basename(dest)[len(stem):]
+    return os.path.join(os.path.dirname(dest), stem + '.delta' + ext)
+
+
+def make_archive(entries, dest, *, base_dir, backend='tarfile', jobs=1):
+    # Write the manifest of (arcname, path) entries next to dest, then the
+    # full archive dest, or only its delta against the manifest of the same
+    # archive in base_dir if there. Return the path of the archive written.
+    manifest = make_manifest(entries, jobs=jobs)
+    stem = _stem(dest)
+    _save_manifest(os.path.join(os.path.dirname(dest),
+                                stem + MANIFEST_EXT), manifest)
+    base_manifest = os.path.join(base_dir, stem + MANIFEST_EXT)
+    if not os.path.exists(base_manifest):
+        logging.info('%s: no base manifest in %s, full archive', stem,
+                     base_dir)
+        with archive.open_tar(dest, backend=backend, threads=jobs) as tar:
+            for arcname, path in entries:
+                tar.add(path, arcname=arcname, recursive=False)
+        return dest
+
+    # Content already in the base is taken from there (by hash, whatever
+    # its path), the rest is added once
+    base = {entry['sha256']: entry['path']
+            for entry in load_manifest(base_manifest)
+            if entry['type'] == 'file'}
+    paths = dict(entries)
+    from_base, added = {}, {}
+    for entry in manifest:
+        if entry['type'] != 'file':
+            continue
+        digest = entry['sha256']
+        if digest in base:
+            from_base[digest] = base[digest]
+        elif digest not in added:
+            added[digest] = paths[entry['path']]
+
+    dest = delta_path(dest)
+    info = json.dumps({'base': from_base, 'entries': manifest}).encode()
+    with archive.open_tar(dest, backend=backend, threads=jobs) as tar:
+        tarinfo = tarfile.TarInfo(_DELTA_INFO)
+        tarinfo.size = len(info)
+        tar.addfile(tarinfo, io.BytesIO(info))
+        for digest, path in added.items():
+            tar.add(path, arcname='{}/{}'.format(_OBJECTS_DIR, digest))
+    size = sum(os.path.getsize(path) for path in added.values())
+    logging.info('%s: delta of %d new files (%d bytes), %d from the base',
+                 stem, len(added), size, len(from_base))
+    return dest
+
+
+def _extract_object(tar, member, objects, digest=None):
+    # Save a regular file member as objects/<sha256>, checking its hash
+    fileobj = tar.extractfile(member)
+    tmp = os.path.join(objects, '.tmp')
+    sha = hashlib.sha256()
+    with open(tmp, 'wb') as f:
+        for chunk in iter(lambda: fileobj.read(1 << 20), b''):
+            sha.update(chunk)
+            f.write(chunk)
+    if digest is not None and sha.hexdigest() != digest:
+        os.unlink(tmp)
+        raise ValueError('{}: content does not match the delta'.format(
+            member.name))
+    os.replace(tmp, os.path.join(objects, sha.hexdigest()))
+
+
+def restore(base, delta, dest, *, jobs=1):
+    # Rebuild the full archive dest (compressed as its extension says) from
+    # the full archive of the base release and a delta made against it
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(dest))) as tmp:
+        objects = os.path.join(tmp, _OBJECTS_DIR)
+        os.makedirs(objects)
+        info = None
+        with archive.read_tar(delta) as tar:
+            for member in tar:
+                if member.name == _DELTA_INFO:
+                    info = json.load(tar.extractfile(member))
+                elif (member.isreg() and
+                      member.name.startswith(_OBJECTS_DIR + '/')):
+                    _extract_object(tar, member, objects)
+        if info is None:
+            raise ValueError('{}: not a delta archive'.format(delta))
+
+        wanted = {path: digest for digest, path in info['base'].items()}
+        with archive.read_tar(base) as tar:
+            for member in tar:
+                digest = wanted.pop(member.name, None)
+                if digest is not None and member.isreg():
+                    _extract_object(tar, member, objects, digest)
+        missing = [entry['path'] for entry in info['entries']
+                   if entry['type'] == 'file' and not os.path.exists(
+                       os.path.join(objects, entry['sha256']))]
+        if missing:
+            raise ValueError('{}: {} files missing from the base, first: '
+                             '{}'.format(base, len(missing), missing[0]))
+
+        with archive.open_tar(dest, backend=archive.backend_of(dest),
+                              threads=jobs) as tar:
+            for entry in info['entries']:
+                tarinfo = tarfile.TarInfo(entry['path'])
+                tarinfo.mode = entry['mode']
+                tarinfo.mtime = entry['mtime']
+                if entry['type'] == 'dir':
+                    tarinfo.type = tarfile.DIRTYPE
+                    tar.addfile(tarinfo)
+                elif entry['type'] == 'link':
+                    tarinfo.type = tarfile.SYMTYPE
+                    tarinfo.linkname = entry['target']
+                    tar.addfile(tarinfo)
+                else:
+                    tarinfo.size = entry['size']
+                    with open(os.path.join(objects, entry['sha256']),
+                              'rb') as f:
+                        tar.addfile(tarinfo, f)
+    return len(info['entries'])
+
+
+def setup_argparse(parser):
+    parser.add_argument('--delta-base',
+                        dest='apps_tools_delta_base',
+                        metavar='DIR',
+                        help='Manifests of the previous release: write ' +
+                        'release archives as deltas against it')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rebuild a full release archive from a delta')
+    parser.add_argument('base', help='full archive of the base release')
+    parser.add_argument('delta', help='delta archive made against base')
+    parser.add_argument('output', help='full archive to write ' +
+                        '(.tar, .tar.gz or .tar.zst)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='compression threads')
+    args = parser.parse_args(argv)
+    count = restore(args.base, args.delta, args.output, jobs=args.jobs)
+    print('{}: {} entries'.format(args.output, count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# Input fingerprints to skip tasks whose inputs and outputs are unchanged
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+# Directories never considered as inputs (build outputs, caches, vcs).
+# Excludes are directory names, or absolute paths of directories.
+EXCLUDES = ('.git', '.gradle', '.idea', '.cxx', '.externalNativeBuild',
+            'build')
+
+# Files modified less than this before the state was saved are hashed again
+# as their modification time may not have been updated by a later change
+_RACY_DELAY_NS = 2 * 1000 * 1000 * 1000
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _list_files(dirs, excludes):
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = sorted(
+                d for d in dirnames if d not in excludes and
+                os.path.join(dirpath, d) not in excludes)
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+
+def scan(tops, match, cache, *, excludes=EXCLUDES):
+    # Files under tops for which match(dirpath, name) is true, as a sorted
+    # list of [path, size, mtime]. cache maps directories to their mtime,
+    # sub directories and matching files in a previous scan (it is updated
+    # in place): directories whose mtime did not change are not listed
+    # again, only their matching files are stat'ed.
+    limit = time.time_ns() - _RACY_DELAY_NS
+    seen = {}
+    files = []
+    pending = list(tops)
+    while pending:
+        dirpath = pending.pop()
+        try:
+            st = os.stat(dirpath)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        entry = cache.get(dirpath)
+        if entry is None or entry[0] != st.st_mtime_ns:
+            subdirs = []
+            names = []
+            with os.scandir(dirpath) as it:
+                for dirent in it:
+                    if dirent.is_dir(follow_symlinks=False):
+                        if (dirent.name not in excludes and
+                                dirent.path not in excludes):
+                            subdirs.append(dirent.name)
+                    elif match(dirpath, dirent.name):
+                        names.append(dirent.name)
+            # A directory modified just now may be modified again without
+            # its mtime changing: list it again next time
+            mtime = st.st_mtime_ns if st.st_mtime_ns < limit else None
+            entry = [mtime, sorted(subdirs), sorted(names)]
+        seen[dirpath] = entry
+        for name in entry[2]:
+            path = os.path.join(dirpath, name)
+            try:
+                fst = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append([path, fst.st_size, fst.st_mtime_ns])
+        pending.extend(os.path.join(dirpath, d) for d in entry[1])
+    cache.clear()
+    cache.update(seen)
+    return sorted(files)
+
+
+def _outputs_signature(outputs):
+    # Outputs are not hashed, size and mtime are enough to notice that
+    # something else modified or removed them
+    entries = []
+    for top in outputs:
+        if not os.path.exists(top):
+            return None
+        if os.path.isfile(top):
+            paths = [top]
+        else:
+            paths = _list_files([top], ())
+        for path in paths:
+            st = os.stat(path)
+            entries.append([path, st.st_size, st.st_mtime_ns])
+    return hashlib.sha256(json.dumps(sorted(entries)).encode()).hexdigest()
+
+
+class Fingerprint:
+    # Fingerprint of a task: its input directories, its parameters (any
+    # json serializable value) and its outputs. The state is kept in
+    # state_dir/<name>.json, with the digest of each input file so that
+    # only files whose size or mtime changed are read again.
+
+    def __init__(self, name, state_dir, *, inputs, values, outputs=(),
+                 excludes=EXCLUDES, jobs=1):
+        self.state_file = os.path.join(state_dir, '{}.json'.format(name))
+        self.inputs = inputs
+        self.values = values
+        self.outputs = outputs
+        self.excludes = excludes
+        self.jobs = jobs
+        self._files = {}
+        self._inputs_digest = None
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _compute(self, state):
+        cached = state.get('files', {})
+        limit = state.get('time', 0) - _RACY_DELAY_NS
+        files = {}
+        # Paths relative to their input, for the same sources to have the
+        # same digest wherever they are
+        names = []
+        to_hash = []
+        for index, top in enumerate(self.inputs):
+            for path in _list_files([top], self.excludes):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                names.append((index, os.path.relpath(path, top), path))
+                entry = cached.get(path)
+                if (entry and entry[0] == st.st_size and
+                        entry[1] == st.st_mtime_ns and
+                        st.st_mtime_ns < limit):
+                    files[path] = entry
+                else:
+                    files[path] = [st.st_size, st.st_mtime_ns, None]
+                    to_hash.append(path)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            for path, digest in zip(to_hash,
+                                    executor.map(_hash_file, to_hash)):
+                files[path][2] = digest
+        digest = hashlib.sha256(json.dumps(self.values,
+                                           sort_keys=True).encode())
+        for index, name, path in sorted(names):
+            digest.update('{}\0{}\0{}\0'.format(
+                index, name, files[path][2]).encode())
+        self._files = files
+        self._inputs_digest = digest.hexdigest()
+
+    def digest(self):
+        # Digest of the inputs and parameters
+        if self._inputs_digest is None:
+            self._compute(self._load())
+        return self._inputs_digest
+
+    def up_to_date(self):
+        state = self._load()
+        self._compute(state)
+        return (state.get('inputs') == self._inputs_digest and
+                state.get('outputs') is not None and
+                state.get('outputs') == _outputs_signature(self.outputs))
+
+    def save(self):
+        # To be called after a successful run of the task
+        state = {
+            'time': time.time_ns(),
+            'inputs': self.digest(),
+            'outputs': _outputs_signature(self.outputs),
+            'files': self._files,
+        }
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        # Several processes may save the same state
+        tmp = '{}.{}.tmp'.format(self.state_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
@@ -0,0 +1,137 @@
+# File system helpers for build outputs, without forking
+import ctypes
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+# ioctl sharing the extents of a file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    elif sys.platform == 'darwin':
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported', dst)
+
+
+def _identical(src, dst):
+    try:
+        st_src = os.stat(src)
+        st_dst = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if (st_src.st_dev, st_src.st_ino) == (st_dst.st_dev, st_dst.st_ino):
+        return True
+    # Staged copies keep the mtime of their source, like cp -p
+    return (not os.path.islink(dst) and
+            st_src.st_size == st_dst.st_size and
+            st_src.st_mtime_ns == st_dst.st_mtime_ns)
+
+
+def stage_file(src, dst, *, hardlink=True):
+    # Make dst a copy of src, sharing data when possible: reflink, then
+    # hardlink (unless disabled), then copy. Nothing is written if dst is
+    # already identical. dst is replaced atomically, never modified in
+    # place (it may be a hardlink of a previous version of src). Return
+    # the method used.
+    if _identical(src, dst):
+        return None
+    tmp = '{}.staging'.format(dst)
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        _reflink(src, tmp)
+        shutil.copystat(src, tmp)
+        method = 'reflink'
+    except OSError:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            if not hardlink:
+                raise OSError(errno.EPERM, 'hardlink disabled', tmp)
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:
+            shutil.copy2(src, tmp)
+            method = 'copy'
+    os.replace(tmp, dst)
+    return method
+
+
+def stage_symlink(target, link):
+    # Make link a symbolic link to target, replacing what is there
+    if os.path.islink(link) and os.readlink(link) == target:
+        return
+    tmp = '{}.staging'.format(link)
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+
+_TRASH_THREADS = []
+_TRASH_DIRS = set()
+_TRASH_LOCK = threading.Lock()
+
+
+def _delete(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def trash(path):
+    # Remove path without waiting: it is atomically renamed into a .trash
+    # directory next to it (same file system, unless path is a mount point:
+    # then it is removed before returning) and deleted by a background
+    # thread. Leftovers of interrupted deletions are removed at the same
+    # time. Use reap_trash to wait for the deletions.
+    if not os.path.lexists(path):
+        return
+    path = os.path.abspath(path)
+    trash_dir = os.path.join(os.path.dirname(path), '.trash')
+    os.makedirs(trash_dir, exist_ok=True)
+    entry = tempfile.mkdtemp(dir=trash_dir)
+    try:
+        os.rename(path, os.path.join(entry, os.path.basename(path)))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # path is a mount point: removed synchronously
+        os.rmdir(entry)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        return
+    to_delete = [entry]
+    with _TRASH_LOCK:
+        if trash_dir not in _TRASH_DIRS:
+            _TRASH_DIRS.add(trash_dir)
+            to_delete.extend(os.path.join(trash_dir, name)
+                             for name in os.listdir(trash_dir)
+                             if os.path.join(trash_dir, name) != entry)
+        # Not a daemon thread: the interpreter waits for it at exit
+        thread = threading.Thread(target=_delete, args=(to_delete,),
+                                  name='trash')
+        thread.start()
+        _TRASH_THREADS.append(thread)
+
+
+def reap_trash():
+    # Wait for the background deletions started by trash
+    with _TRASH_LOCK:
+        threads = list(_TRASH_THREADS)
+        _TRASH_THREADS.clear()
+    for thread in threads:
+        thread.join()
@@ -1,11 +1,19 @@
 # base to build an iOS application
 import os
+import logging
 import dragon
 import shutil
-import tarfile
 import collections
 
+import apps_tools.archive as archive
+import apps_tools.checksums as checksums
 import apps_tools.common as common
+import apps_tools.delta as delta
+import apps_tools.fsutil as fsutil
+import apps_tools.logcapture as logcapture
+import apps_tools.pressure as pressure
+import apps_tools.shard as shard
+import apps_tools.trace as trace
 
 
 def _set_product():
@@ -13,9 +21,9 @@ def _set_product():
         f.write('ALCHEMY_PRODUCT = {}\n'.format(dragon.PRODUCT))
 
 
-def _xctool(calldir, workspace, configuration, scheme,
-            action, reporter, extra_args):
-    cmd = ['xctool']
+def _xctool_cmd(workspace, configuration, scheme, action, reporter,
+                extra_args, options=(), runner='xctool'):
+    cmd = [runner]
     if (dragon.VARIANT == 'ios_sim'):
         cmd.append('--sdk iphonesimulator')
         if not any('destination' in arg for arg in extra_args):
@@ -28,27 +36,118 @@ def _xctool(calldir, workspace, configuration, scheme,
     cmd.append('--reporter pretty')
     if (reporter):
         cmd.append('--reporter {}'.format(reporter))
+    cmd.extend(options)
     cmd.append(action)
     cmd.extend(extra_args)
-    dragon.exec_cmd(' '.join(cmd), cwd=calldir)
+    return cmd
+
+
+def _xctool(calldir, workspace, configuration, scheme,
+            action, reporter, extra_args, runner='xctool'):
+    cmd = _xctool_cmd(workspace, configuration, scheme, action, reporter,
+                      extra_args, runner=runner)
+    common.exec_cmd(' '.join(cmd), cwd=calldir)
+
+
+def _xctool_sharded(name, calldir, workspace, configuration, scheme, action,
+                    reporter, extra_args, shards, destinations, test_target,
+                    tests, runner, durations_file):
+    # Run the tests of test_target in concurrent xctool processes, each
+    # with its own destination, balanced by the durations of earlier runs.
+    # Without given tests, the test classes are the ones of earlier runs
+    # and a catch-all shard runs the others (added since). Without any
+    # (first run), all of them run in a single shard to record their
+    # durations.
+    out_dir = os.path.join(dragon.OUT_DIR, 'xctool', name)
+    if not durations_file:
+        durations_file = os.path.join(out_dir, 'durations.json')
+    durations = shard.load_durations(durations_file)
+    catch_all = not tests
+    tests = sorted(set(tests or durations))
+    # A destination per shard, the catch-all shard included
+    shards = min(shards, len(destinations)) - (1 if catch_all else 0)
+    if tests and shards > 0:
+        groups = [('-only', group)
+                  for group in shard.balance(tests, durations, shards)]
+        if catch_all:
+            groups.append(('-omit', tests))
+    else:
+        groups = [(None, None)]
+
+    cmds = []
+    reports = []
+    for idx, (selector, group) in enumerate(groups):
+        report = os.path.join(out_dir, 'shard-{}.xml'.format(idx))
+        if os.path.exists(report):
+            os.unlink(report)
+        reports.append(report)
+        options = ["-destination '{}'".format(destinations[idx])]
+        args = list(extra_args)
+        if group:
+            args.append('{} {}:{}'.format(selector, test_target,
+                                          ','.join(group)))
+        cmd = _xctool_cmd(workspace, configuration, scheme, action,
+                          'junit:{}'.format(report), args, options, runner)
+        cmds.append(('{}-shard{}'.format(name, idx), ' '.join(cmd), calldir,
+                     os.path.join(out_dir, 'shard-{}.log'.format(idx))))
+    success = False
+    try:
+        common.exec_cmds_parallel(cmds)
+        success = True
+    finally:
+        # Reports of failed shards are merged too
+        if reporter and reporter.startswith('junit:'):
+            merged = reporter[len('junit:'):]
+        else:
+            merged = os.path.join(out_dir, 'report.xml')
+        recorded = shard.merge_junit(reports, merged)
+        # After a complete run, forget the tests that no longer exist
+        if success:
+            durations = recorded
+        else:
+            durations.update(recorded)
+        shard.save_durations(durations_file, durations)
+        logging.info('Test report of %d shard(s) in %s', len(groups),
+                     merged)
 
 
 def add_xctool_task(calldir='', workspace='', configuration='',
                     scheme='', action='', reporter=None, extra_args=[],
-                    name='', desc='', subtasks=[]):
+                    name='', desc='', subtasks=[], *, shards=1,
+                    destinations=None, test_target=None, tests=None,
+                    runner='xctool', durations_file=None):
+    if getattr(dragon.OPTIONS, 'ios_xctool_shards', None):
+        shards = dragon.OPTIONS.ios_xctool_shards
+    if shards > 1 and (action != 'run-tests' or not test_target):
+        # Concurrent builds would share the same DerivedData
+        dragon.LOGW('{}: sharding needs the run-tests action and a test '
+                    'target, running unsharded'.format(name))
+        shards = 1
+    if shards > 1 and not destinations:
+        # Concurrent runs would share the same simulator or device
+        dragon.LOGW('{}: sharding needs destinations, running '
+                    'unsharded'.format(name))
+        shards = 1
+    if shards > 1:
+        posthook = trace.hook('xctool', lambda task, args: _xctool_sharded(
+            name, calldir, workspace, configuration, scheme, action,
+            reporter, extra_args, shards, destinations, test_target, tests,
+            runner, durations_file))
+    else:
+        posthook = trace.hook('xctool', lambda task, args: _xctool(
+            calldir, workspace, configuration, scheme, action, reporter,
+            extra_args, runner))
     dragon.add_meta_task(
         name=name,
         desc=desc,
         subtasks=subtasks,
-        posthook=lambda task, args: _xctool(calldir, workspace,
-                                            configuration, scheme,
-                                            action, reporter,
-                                            extra_args)
+        posthook=posthook
     )
 
 
-def _xcodebuild(calldir, workspace, configuration, scheme, action, bundle_id,
-                team_id, extra_args, short_version):
+def _xcodebuild_cmd(calldir, workspace, configuration, scheme, action,
+                    bundle_id, team_id, extra_args, short_version,
+                    derived_data=None):
     # get the real version
     version = dragon.PARROT_BUILD_VERSION
     # create a fake version which is a pure release from the current version
@@ -86,7 +185,9 @@ def _xcodebuild(calldir, workspace, configuration, scheme, action, bundle_id,
     cmd.append('-configuration {}'.format(configuration))
     cmd.append('-scheme {}'.format(scheme))
     cmd.append('-allowProvisioningUpdates')
-    if os.environ.get('MOVE_APPSDATA_IN_OUTDIR'):
+    if derived_data:
+        cmd.append('-derivedDataPath {}'.format(derived_data))
+    elif os.environ.get('MOVE_APPSDATA_IN_OUTDIR'):
         cmd.append('-derivedDataPath {}'.format(os.path.join(
             dragon.OUT_DIR, 'xcodeDerivedData')))
     if asan:
@@ -105,19 +206,35 @@ def _xcodebuild(calldir, workspace, configuration, scheme, action, bundle_id,
     cmd.append('APP_VERSION={}'.format(vshort if short_version else vlong))
     cmd.append('APP_BUILD={}'.format(vcode))
     cmd.extend(extra_args)
+    return cmd
+
+
+def _xcodebuild(calldir, workspace, configuration, scheme, action, bundle_id,
+                team_id, extra_args, short_version):
+    cmd = _xcodebuild_cmd(calldir, workspace, configuration, scheme, action,
+                          bundle_id, team_id, extra_args, short_version)
+    # Fewer build jobs while memory is short
+    guard = pressure.wait('xcodebuild')
+    if guard is not None:
+        cmd.append('-jobs {}'.format(guard.workers(
+            dragon.OPTIONS.jobs.job_num)))
+    display = None
     if not dragon.OPTIONS.verbose and shutil.which('xcpretty'):
-        cmd.append('| xcpretty && exit ${PIPESTATUS[0]}')
-    dragon.exec_cmd(' '.join(cmd), cwd=calldir)
+        if logcapture.enabled():
+            # Full output in the log, xcpretty only for the terminal
+            display = 'xcpretty'
+        else:
+            cmd.append('| xcpretty && exit ${PIPESTATUS[0]}')
+    common.exec_cmd(' '.join(cmd), cwd=calldir, display=display)
 
 
 def add_xcodebuild_task(*, calldir='', workspace='', configuration='',
                         scheme='', action='', bundle_id=None, team_id=None,
                         extra_args=[], short_version=False, **kwargs):
     dragon.add_meta_task(
-        posthook=lambda task, args: _xcodebuild(calldir, workspace,
-                                                configuration, scheme,
-                                                action, bundle_id, team_id,
-                                                extra_args, short_version),
+        posthook=trace.hook('xcodebuild', lambda task, args: _xcodebuild(
+            calldir, workspace, configuration, scheme, action, bundle_id,
+            team_id, extra_args, short_version)),
         **kwargs
     )
 
@@ -128,12 +245,13 @@ def _jazzy(calldir, scheme, extra_args):
     outdir = os.path.join(dragon.OUT_DIR, 'docs')
     cmd.append('-o {}'.format(outdir))
     cmd.extend(extra_args)
-    dragon.exec_cmd(' '.join(cmd), cwd=calldir)
+    common.exec_cmd(' '.join(cmd), cwd=calldir)
 
 
 def add_jazzy_task(*, calldir='', scheme='', extra_args=[], **kwargs):
     dragon.add_meta_task(
-        posthook=lambda task, args: _jazzy(calldir, scheme, extra_args),
+        posthook=trace.hook('jazzy', lambda task, args: _jazzy(
+            calldir, scheme, extra_args)),
         **kwargs
     )
 
@@ -203,7 +321,7 @@ def _export_archive(dirpath, archive_path, app):
           '-allowProvisioningUpdates -exportPath {}'.format(archive_path,
                                                             export_plist,
                                                             ipa_path)
-    dragon.exec_cmd(cwd=dirpath, cmd=cmd)
+    common.exec_cmd(cmd, cwd=dirpath)
     ipa_raw_path = '{}/{}.ipa'.format(ipa_path, app.scheme)
     os.makedirs(ipa_out_path, exist_ok=True)
     ipa_final_path = '{}/{}'.format(ipa_out_path, app.ipa_name)
@@ -212,9 +330,9 @@ def _export_archive(dirpath, archive_path, app):
 
 
 def _hook_pre_images(task, args):
-    # cleanup
-    dragon.exec_cmd(cwd=dragon.OUT_DIR, cmd='rm -rf images')
-    dragon.exec_cmd(cwd=dragon.OUT_DIR, cmd='rm -rf xcodeApps')
+    # cleanup (deletion continues in background)
+    fsutil.trash(os.path.join(dragon.OUT_DIR, 'images'))
+    fsutil.trash(os.path.join(dragon.OUT_DIR, 'xcodeApps'))
     manifest_path = os.path.join(dragon.OUT_DIR, 'manifest.xml')
     dragon.gen_manifest_xml(manifest_path)
     task.call_base_pre_hook(args)
@@ -266,41 +384,72 @@ class App:
         return 'build archive {} for release'.format(self.name)
 
 
-def _make_hook_images(calldir, apps):
+def _compress_archive(app, images_dir, compression, threads,
+                      delta_base=None):
+    archive_path = app._archivePath(dragon.OUT_DIR)
+    archive_dir = os.path.dirname(archive_path)
+    archive_name = os.path.basename(archive_path)
+    tarname = os.path.join(images_dir, '{}{}'.format(
+        archive_name, archive.tar_ext(compression)))
+    if delta_base is not None:
+        return delta.make_archive(
+            delta.tree_entries(archive_dir, archive_name), tarname,
+            base_dir=delta_base, backend=compression, jobs=threads)
+    archive.make_tar(archive_dir, archive_name, tarname,
+                     backend=compression, threads=threads)
+    return tarname
+
+
+def _make_hook_images(calldir, apps, compression='tarfile', delta_base=None):
     def _hook_images(task, args):
 
         images_dir = os.path.join(dragon.OUT_DIR, 'images')
         dragon.makedirs(images_dir)
 
-        for app in apps:
-            archive_path = app._archivePath(dragon.OUT_DIR)
-            # Compress .xcarchive
-            archive_dir = os.path.dirname(archive_path)
-            archive_name = os.path.basename(archive_path)
-            tarname = os.path.join(
-                images_dir,
-                '{}.tar.gz'.format(os.path.basename(archive_path)))
-            cwd = os.getcwd()
-            os.chdir(archive_dir)
-            tar = tarfile.open(tarname, 'w:gz')
-            tar.add(archive_name)
-            tar.close()
-            os.chdir(cwd)
+        # checksums of the release files, computed as they are produced
+        sums = checksums.release_manifest()
+
+        # Compress .xcarchive(s) and export .ipa(s) as a pipeline: the
+        # export of an app (mostly waiting xcodebuild) runs while the next
+        # one is compressed. Exports share export.plist so run one by one.
+        # Multi-threaded backends get all the jobs for a single archive at
+        # a time, otherwise several archives are compressed at once.
+        job_num = dragon.OPTIONS.jobs.job_num
+        if compression == 'tarfile':
+            compress_workers = max(1, min(len(apps), job_num))
+            threads = 1
+        else:
+            compress_workers = 1
+            threads = job_num
+
+        def _compress(app):
+            with trace.span('compress {}'.format(app.name)):
+                sums.add(_compress_archive(app, images_dir, compression,
+                                           threads, delta_base))
+            return app
 
+        def _export(app):
+            archive_path = app._archivePath(dragon.OUT_DIR)
             inhouse_path = _export_archive(calldir,
                                            archive_path,
                                            app)
             # Link .ipa
             if inhouse_path:
-                dragon.exec_cmd(cwd=images_dir,
-                                cmd='ln -s {} {}'.format(inhouse_path,
-                                                         app.ipa_name))
+                ipa_link = os.path.join(images_dir, app.ipa_name)
+                fsutil.stage_symlink(inhouse_path, ipa_link)
+                sums.add(ipa_link)
+
+        common.run_pipeline(apps, [(_compress, compress_workers),
+                                   (_export, 1)])
 
         # build.prop
         build_prop_file = os.path.join(dragon.OUT_DIR, 'staging', 'etc',
                                        'build.prop')
-        dragon.exec_cmd(cwd=dragon.OUT_DIR,
-                        cmd='cp {} .'.format(build_prop_file))
+        fsutil.stage_file(build_prop_file,
+                          os.path.join(dragon.OUT_DIR, 'build.prop'))
+        sums.add(os.path.join(dragon.OUT_DIR, 'build.prop'))
+
+        sums.write()
 
         # next hooks
         task.call_base_exec_hook(args)
@@ -309,26 +458,68 @@ def _make_hook_images(calldir, apps):
 
 def _make_rm_previous_archive(app):
     def _rm_previous_archive(task, args):
-        dragon.exec_cmd('rm -rf {}'.format(app._archivePath(dragon.OUT_DIR)))
+        fsutil.trash(app._archivePath(dragon.OUT_DIR))
     return _rm_previous_archive
 
 
+def _archive_args(app):
+    args = [
+        '-archivePath {}'.format(app._archivePath(dragon.OUT_DIR,
+                                                  skipExt=True)),
+    ]
+    if app.args:
+        args.extend(app.args)
+    return args
+
+
+def _build_archives_parallel(calldir, workspace, apps, max_parallel):
+    # Each archive gets its own DerivedData so that concurrent xcodebuild
+    # instances do not fight over the same build database lock.
+    log_dir = os.path.join(dragon.OUT_DIR, 'logs')
+    cmds = []
+    for app in apps:
+        fsutil.trash(app._archivePath(dragon.OUT_DIR))
+        derived_data = os.path.join(dragon.OUT_DIR,
+                                    'xcodeDerivedData-{}'.format(app.name))
+        cmd = _xcodebuild_cmd(calldir, workspace, app.configuration,
+                              app.scheme, 'archive', app.bundle_id,
+                              app.build_team_id, _archive_args(app),
+                              app.short_version, derived_data=derived_data)
+        cmds.append((app._taskName(), ' '.join(cmd), calldir,
+                     os.path.join(log_dir,
+                                  '{}.log'.format(app._taskName()))))
+    common.exec_cmds_parallel(cmds, max_workers=max_parallel)
+
+
+def setup_argparse(parser):
+    parser.add_argument('--parallel-archives',
+                        dest='ios_parallel_archives',
+                        type=int,
+                        metavar='N',
+                        help='Build up to N release archives concurrently')
+    parser.add_argument('--xctool-shards',
+                        dest='ios_xctool_shards',
+                        type=int,
+                        metavar='N',
+                        help='Run the tests of xctool tasks in N shards')
+
+
 def add_release_task(*, calldir='', workspace='', apps=[], extra_tasks=[],
-                     build_common_task='build-common'):
+                     build_common_task='build-common', parallel_archives=1,
+                     archive_compression='tarfile', delta_base=None):
+    if getattr(dragon.OPTIONS, 'ios_parallel_archives', None):
+        parallel_archives = dragon.OPTIONS.ios_parallel_archives
+    if getattr(dragon.OPTIONS, 'apps_tools_delta_base', None):
+        delta_base = dragon.OPTIONS.apps_tools_delta_base
+
     subtasks = []
     for app in apps:
-        _args = [
-            '-archivePath {}'.format(app._archivePath(dragon.OUT_DIR,
-                                                      skipExt=True)),
-        ]
-        if app.args:
-            _args.extend(app.args)
-
         add_xcodebuild_task(
             name=app._taskName(),
             desc=app._taskDesc(),
             subtasks=[build_common_task],
-            prehook=_make_rm_previous_archive(app),
+            prehook=trace.hook('rm-previous-archive',
+                               _make_rm_previous_archive(app)),
             calldir=calldir,
             workspace=workspace,
             configuration=app.configuration,
@@ -336,23 +527,48 @@ def add_release_task(*, calldir='', workspace='', apps=[], extra_tasks=[],
             bundle_id=app.bundle_id,
             action='archive',
             team_id=app.build_team_id,
-            extra_args=_args,
+            extra_args=_archive_args(app),
             secondary_help=True,
             short_version=app.short_version
         )
         subtasks.append(app._taskName())
 
+    # Build all archives at once, up to parallel_archives at a time
+    if parallel_archives > 1 and len(apps) > 1:
+        dragon.add_meta_task(
+            name='build-archives',
+            desc='build all archives for release',
+            subtasks=[build_common_task],
+            posthook=trace.hook('parallel', lambda task, args:
+                                _build_archives_parallel(calldir, workspace,
+                                                         apps,
+                                                         parallel_archives)),
+            secondary_help=True
+        )
+        subtasks = ['build-archives']
+
     dragon.override_meta_task(
         name='images-all',
-        prehook=_hook_pre_images,
-        exechook=_make_hook_images(calldir, apps)
+        prehook=trace.hook('pre-images', _hook_pre_images),
+        exechook=trace.hook('images', _make_hook_images(calldir, apps,
+                                                        archive_compression,
+                                                        delta_base))
     )
 
+    # Extra tasks are assumed to only need the archives
+    deps = {task: [] for task in subtasks}
+    deps['images-all'] = list(subtasks)
+    deps.update((extra, list(subtasks)) for extra in extra_tasks)
+    deps['gen-release-archive'] = ['images-all'] + extra_tasks
+    common.set_release_graph(deps)
+
     subtasks.append('images-all')
     subtasks.extend(extra_tasks)
     subtasks.append('gen-release-archive')
 
     dragon.override_meta_task(
         name='release',
-        subtasks=subtasks
+        subtasks=subtasks,
+        prehook=common.start_release,
+        posthook=common.finish_release
     )
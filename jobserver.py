@@ -0,0 +1,163 @@
+# GNU make jobserver (fifo and token protocol) shared by the commands run
+# by apps_tools: ndk-build joins it as a make client, gradle and the
+# alchemy builds get a worker count from the tokens they hold, so that
+# their total concurrency stays within the -j of the dragon invocation.
+import atexit
+import contextlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import dragon
+
+import apps_tools.trace as trace
+
+# File descriptor of the fifo in the commands of make clients
+_CLIENT_FD = 3
+
+
+class JobServer:
+    def __init__(self, path, slots=None):
+        # Create the fifo with slots tokens, or join the existing one at
+        # path (slots is None)
+        self.path = path
+        self.owner = slots is not None
+        if self.owner:
+            os.mkfifo(path, 0o600)
+        # Read/write so that opening does not wait for a peer and reads
+        # block until a token is there instead of returning end of file
+        self._fd = os.open(path, os.O_RDWR)
+        self._nb_fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        if self.owner:
+            os.write(self._fd, b'+' * slots)
+        self.slots = slots
+
+    def close(self):
+        os.close(self._fd)
+        os.close(self._nb_fd)
+        if self.owner:
+            os.unlink(self.path)
+
+    def try_acquire(self, count):
+        # Take up to count tokens without waiting
+        tokens = b''
+        while len(tokens) < count:
+            try:
+                token = os.read(self._nb_fd, count - len(tokens))
+            except BlockingIOError:
+                break
+            if not token:
+                break
+            tokens += token
+        return tokens
+
+    def acquire(self, count=1):
+        # Wait for a token, then take up to count ones without waiting.
+        # Return the tokens taken (to be given back to release).
+        tokens = os.read(self._fd, 1)
+        return tokens + self.try_acquire(count - 1)
+
+    def release(self, tokens):
+        if tokens:
+            os.write(self._fd, tokens)
+
+    @contextlib.contextmanager
+    def tokens(self, count=1):
+        # Hold between 1 and count tokens, yield their number
+        start = time.monotonic()
+        tokens = self.acquire(count)
+        wait = time.monotonic() - start
+        if wait >= 0.1:
+            logging.info('jobserver: waited %.1fs for %d slot(s)', wait,
+                         len(tokens))
+        trace.annotate(slots=len(tokens), slots_wait=round(wait, 3))
+        try:
+            yield len(tokens)
+        finally:
+            self.release(tokens)
+
+    def make_cmd(self, cmd):
+        # Shell command running cmd (a make without -j) as a client of the
+        # jobserver. A make client has an implicit token: hold it while the
+        # command runs.
+        return ('MAKEFLAGS="-j --jobserver-auth={fd},{fd} --jobserver-fds='
+                '{fd},{fd}" {cmd} {fd}<>{path}'.format(
+                    fd=_CLIENT_FD, cmd=cmd, path=self.path))
+
+
+_JOBSERVER = None
+_LOCK = threading.Lock()
+
+
+def _enabled():
+    return getattr(dragon.OPTIONS, 'apps_tools_jobserver', True)
+
+
+def _from_makeflags():
+    # Fifo of a make (>= 4.4) jobserver running dragon
+    match = re.search(r'--jobserver-auth=fifo:(\S+)',
+                      os.environ.get('MAKEFLAGS', ''))
+    return match.group(1) if match else None
+
+
+def get():
+    # The jobserver of this dragon invocation, created on first use, or
+    # None if disabled
+    global _JOBSERVER
+    if not _enabled():
+        return None
+    with _LOCK:
+        if _JOBSERVER is None:
+            path = _from_makeflags()
+            if path and os.path.exists(path):
+                _JOBSERVER = JobServer(path)
+                logging.debug('jobserver: joined %s', path)
+            else:
+                tmp_dir = tempfile.mkdtemp(prefix='apps_tools-jobserver-')
+                slots = max(1, dragon.OPTIONS.jobs.job_num)
+                _JOBSERVER = JobServer(os.path.join(tmp_dir, 'fifo'), slots)
+                atexit.register(_cleanup, tmp_dir)
+                logging.debug('jobserver: %d slots in %s', slots,
+                              _JOBSERVER.path)
+        return _JOBSERVER
+
+
+def _cleanup(tmp_dir):
+    global _JOBSERVER
+    if _JOBSERVER is not None:
+        _JOBSERVER.close()
+        _JOBSERVER = None
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def slots(count):
+    # Hold up to count slots of the jobserver, yield the number obtained
+    # (None if disabled)
+    server = get()
+    if server is None:
+        yield None
+        return
+    with server.tokens(count) as got:
+        yield got
+
+
+def make_cmd(cmd, job_num):
+    # Shell command running the make based cmd as a client of the
+    # jobserver, or with -jjob_num if disabled
+    server = get()
+    if server is None:
+        return '{} -j{}'.format(cmd, job_num)
+    return server.make_cmd(cmd)
+
+
+def setup_argparse(parser):
+    parser.add_argument('--no-jobserver',
+                        dest='apps_tools_jobserver',
+                        action='store_false',
+                        help='Do not share the -j slots between the ' +
+                        'commands run by apps_tools')
@@ -0,0 +1,212 @@
+# Capture of the output of the commands run by apps_tools (opt-in): the full
+# output is streamed compressed to a log file in OUT_DIR/logs, the last lines
+# are kept in memory to be shown on failure and warnings and errors are
+# extracted into a summary, with bounded memory whatever the size of the
+# output. Only a display filter of the output (xcpretty) reaches the
+# terminal.
+import collections
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+import dragon
+
+import apps_tools.trace as trace
+
+# Lines shown on failure by default
+TAIL_LINES = 100
+
+# Lines longer than this are split (for the tail and the parser only)
+_MAX_LINE = 64 * 1024
+
+# Distinct warnings and errors kept in the summary, shown at the end
+_MAX_ISSUES = 200
+_SHOWN_ISSUES = 20
+
+# Fast compression, logs compress well anyway
+_COMPRESS_LEVEL = 3
+
+_ISSUE_RES = [
+    # clang, gcc, swiftc, javac: file:line[:col]: warning|error: message
+    re.compile(r'^(?P<file>[^\s:][^:]*):(?P<line>\d+):(?:\d+:)?\s*'
+               r'(?P<kind>warning|error|fatal error):\s*(?P<message>.*)$'),
+    # kotlinc: w|e: [file://]file[:line:col| (line, col):] message
+    re.compile(r'^(?P<kind>[we]): (?:file://)?(?P<file>[^\s:]+)'
+               r'(?::(?P<line>\d+):\d+|: \((?P<line2>\d+), \d+\):) '
+               r'(?P<message>.*)$'),
+    # linkers, drivers and build tools: tool: warning|error: message
+    re.compile(r'^(?:(?P<tool>[\w.+-]+): )?'
+               r'(?P<kind>warning|error|fatal error|WARNING|ERROR|FAILURE):'
+               r'\s*(?P<message>.*)$'),
+]
+
+_KINDS = {'w': 'warning', 'e': 'error', 'fatal error': 'error',
+          'WARNING': 'warning', 'ERROR': 'error', 'FAILURE': 'error'}
+
+
+def enabled():
+    return getattr(dragon.OPTIONS, 'apps_tools_log_capture', None) is not None
+
+
+_SEQ = itertools.count(1)
+_SEQ_LOCK = threading.Lock()
+
+
+def log_path(name, log_file=None):
+    # Compressed log of a command, numbered in order of the commands when
+    # not given
+    if log_file:
+        return '{}.gz'.format(log_file)
+    with _SEQ_LOCK:
+        seq = next(_SEQ)
+    return os.path.join(dragon.OUT_DIR, 'logs', '{:03d}-{}.log.gz'.format(
+        seq, re.sub(r'[^\w.+-]', '_', name)))
+
+
+class Capture:
+    def __init__(self, log_file, tail=TAIL_LINES):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        self.log_file = log_file
+        self._log = gzip.open(log_file, 'wb', compresslevel=_COMPRESS_LEVEL)
+        self.tail = collections.deque(maxlen=tail)
+        self.lines = 0
+        self.counts = {'warning': 0, 'error': 0}
+        # (kind, file, line, message) -> occurrences, in order of appearance
+        self.issues = collections.OrderedDict()
+
+    def feed(self, data):
+        # data: bytes of a line (or part of a too long one) of the output
+        self._log.write(data)
+        line = data.decode('utf-8', errors='replace').rstrip('\r\n')
+        self.lines += 1
+        self.tail.append(line)
+        self._parse(line)
+
+    def _parse(self, line):
+        for issue_re in _ISSUE_RES:
+            match = issue_re.match(line)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            kind = _KINDS.get(groups['kind'], groups['kind'])
+            self.counts[kind] += 1
+            key = (kind, groups.get('file') or groups.get('tool'),
+                   groups.get('line') or groups.get('line2'),
+                   groups['message'][:1024])
+            if key in self.issues:
+                self.issues[key] += 1
+            elif len(self.issues) < _MAX_ISSUES:
+                self.issues[key] = 1
+            return
+
+    def close(self):
+        self._log.close()
+
+    def summary(self):
+        return {
+            'log': self.log_file,
+            'lines': self.lines,
+            'warnings': self.counts['warning'],
+            'errors': self.counts['error'],
+            'issues': [{'kind': kind, 'file': path,
+                        'line': int(line) if line else None,
+                        'message': message, 'count': count}
+                       for (kind, path, line, message), count
+                       in self.issues.items()],
+        }
+
+
+def _summary_path(log_file):
+    return re.sub(r'(\.log)?\.gz$', '', log_file) + '.summary.json'
+
+
+def _issue_str(issue):
+    where = issue['file'] or ''
+    if issue['line']:
+        where += ':{}'.format(issue['line'])
+    text = '{}: {}'.format(issue['kind'], issue['message'])
+    if where:
+        text = '{}: {}'.format(where, text)
+    if issue['count'] > 1:
+        text += ' (x{})'.format(issue['count'])
+    return text
+
+
+def run(cmd, cwd=None, *, name, log_file=None, display=None):
+    # Run cmd with its output captured in log_file (see log_path), display
+    # being a shell command the output is piped to for the terminal. Raise
+    # dragon.ExecError on failure, after showing the last lines of output.
+    if log_file is None:
+        log_file = log_path(name)
+    logging.info('%s', cmd)
+    if getattr(dragon.OPTIONS, 'dryrun', False):
+        return
+    tail = dragon.OPTIONS.apps_tools_log_capture
+    capture = Capture(log_file, tail=tail)
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    viewer = viewer_in = None
+    if display:
+        viewer = subprocess.Popen(display, shell=True, cwd=cwd, bufsize=0,
+                                  stdin=subprocess.PIPE)
+        viewer_in = viewer.stdin
+    try:
+        for data in iter(lambda: proc.stdout.readline(_MAX_LINE), b''):
+            capture.feed(data)
+            if viewer_in is not None:
+                try:
+                    viewer_in.write(data)
+                except BrokenPipeError:
+                    # The display went away, keep capturing
+                    viewer_in = None
+        ret = proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        capture.close()
+        if viewer is not None:
+            try:
+                viewer.stdin.close()
+            except BrokenPipeError:
+                pass
+            viewer.wait()
+
+    summary = capture.summary()
+    with open(_summary_path(log_file), 'w') as f:
+        json.dump(summary, f, indent=1)
+    trace.annotate(log=log_file, log_lines=summary['lines'],
+                   warnings=summary['warnings'], errors=summary['errors'])
+    logging.info('%s: %d lines, %d warnings, %d errors in %.1fs, log in %s',
+                 name, summary['lines'], summary['warnings'],
+                 summary['errors'], time.monotonic() - start, log_file)
+    if ret != 0:
+        logging.error('%s: last %d lines of output:\n%s', name,
+                      len(capture.tail), '\n'.join(capture.tail))
+        errors = [issue for issue in summary['issues']
+                  if issue['kind'] == 'error']
+        for issue in errors[:_SHOWN_ISSUES]:
+            logging.error('%s: %s', name, _issue_str(issue))
+        raise dragon.ExecError('Command failed ({}): {}'.format(ret, cmd))
+
+
+def setup_argparse(parser):
+    parser.add_argument('--log-capture',
+                        dest='apps_tools_log_capture',
+                        metavar='LINES',
+                        nargs='?',
+                        type=int,
+                        const=TAIL_LINES,
+                        help='Write the output of the commands run by ' +
+                        'apps_tools to compressed logs, showing the last ' +
+                        'LINES lines (default {}) on failure'.format(
+                            TAIL_LINES))
@@ -0,0 +1,191 @@
+# Memory pressure guard of the commands run by apps_tools. A background
+# thread samples the available memory and the memory pressure stall
+# information (PSI) of the system, and holds back jobserver slots when
+# pressure rises: running make clients then start fewer jobs, new commands
+# get fewer workers. Commands are not started at all while memory is
+# critically low.
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+import dragon
+
+import apps_tools.jobserver as jobserver
+import apps_tools.trace as trace
+
+# Seconds between samples
+INTERVAL = 2.0
+
+# Hold back one more slot per sample above these (PSI 'some' avg10 in
+# percent, available memory in percent of the total), give one back per
+# sample below the second ones
+HIGH_PSI, LOW_PSI = 10.0, 2.0
+HIGH_AVAIL, LOW_AVAIL = 15.0, 25.0
+
+# Do not start commands while above these (PSI 'full' avg10, available
+# memory), for at most DEFER_TIMEOUT seconds
+CRITICAL_PSI = 10.0
+CRITICAL_AVAIL = 5.0
+DEFER_TIMEOUT = 600.0
+
+
+class Sample:
+    def __init__(self, avail, some=None, full=None):
+        # available memory in percent, PSI avg10 percentages (None if not
+        # supported)
+        self.avail = avail
+        self.some = some
+        self.full = full
+
+    def __str__(self):
+        text = 'available {:.0f}%'.format(self.avail)
+        if self.some is not None:
+            text += ', psi some {:.1f} full {:.1f}'.format(self.some,
+                                                           self.full)
+        return text
+
+    def high(self):
+        return ((self.some or 0) > HIGH_PSI) or self.avail < HIGH_AVAIL
+
+    def low(self):
+        return ((self.some or 0) < LOW_PSI) and self.avail > LOW_AVAIL
+
+    def critical(self):
+        return ((self.full or 0) > CRITICAL_PSI or
+                self.avail < CRITICAL_AVAIL)
+
+
+def _read_psi():
+    values = {}
+    try:
+        with open('/proc/pressure/memory', 'r') as f:
+            for line in f:
+                kind, *fields = line.split()
+                values[kind] = float(dict(field.split('=')
+                                          for field in fields)['avg10'])
+    except OSError:
+        return None, None
+    return values.get('some'), values.get('full')
+
+
+def sample():
+    # Current memory state, None if unknown on this system
+    if sys.platform == 'darwin':
+        try:
+            level = subprocess.check_output(
+                ['sysctl', '-n', 'kern.memorystatus_level'],
+                stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return Sample(float(level))
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+    except OSError:
+        return None
+    if not meminfo.get('MemTotal') or 'MemAvailable' not in meminfo:
+        return None
+    return Sample(100.0 * meminfo['MemAvailable'] / meminfo['MemTotal'],
+                  *_read_psi())
+
+
+class Guard:
+    def __init__(self, server):
+        self.server = server
+        self.withheld = b''
+        thread = threading.Thread(target=self._run, name='pressure',
+                                  daemon=True)
+        thread.start()
+
+    def _set_withheld(self, count, state):
+        if self.server is None:
+            return
+        if count > len(self.withheld):
+            # Only take free slots, busy ones are taken when released
+            self.withheld += self.server.try_acquire(
+                count - len(self.withheld))
+        elif count < len(self.withheld):
+            self.server.release(self.withheld[count:])
+            self.withheld = self.withheld[:count]
+        else:
+            return
+        logging.info('memory pressure: %s, holding back %d of %d slots',
+                     state, len(self.withheld), self.server.slots or 0)
+        trace.mark('pressure', withheld=len(self.withheld),
+                   state=str(state))
+
+    def _run(self):
+        while True:
+            time.sleep(INTERVAL)
+            state = sample()
+            if state is None or self.server is None:
+                continue
+            # Always leave a slot to make progress (the number of slots of
+            # a joined jobserver is unknown)
+            limit = max(0, (self.server.slots or 1) - 1)
+            if state.high():
+                self._set_withheld(min(limit, len(self.withheld) + 1), state)
+            elif state.low() and self.withheld:
+                self._set_withheld(len(self.withheld) - 1, state)
+
+    def workers(self, count):
+        # count reduced by the slots held back
+        return max(1, count - len(self.withheld))
+
+
+_GUARD = None
+_LOCK = threading.Lock()
+
+
+def _enabled():
+    return getattr(dragon.OPTIONS, 'apps_tools_memory_guard', False)
+
+
+def get():
+    # The guard of this dragon invocation, started on first use, or None
+    # if disabled or not supported
+    global _GUARD
+    if not _enabled():
+        return None
+    with _LOCK:
+        if _GUARD is None:
+            if sample() is None:
+                logging.warning('memory pressure: not supported here')
+                dragon.OPTIONS.apps_tools_memory_guard = False
+                return None
+            _GUARD = Guard(jobserver.get())
+        return _GUARD
+
+
+def wait(name):
+    # Defer the start of command name while memory is critically low.
+    # Return the guard (None if disabled).
+    guard = get()
+    if guard is None:
+        return None
+    start = time.monotonic()
+    state = sample()
+    if state is not None and state.critical():
+        logging.warning('memory pressure: %s, deferring %s', state, name)
+        while (state is not None and state.critical() and
+               time.monotonic() - start < DEFER_TIMEOUT):
+            time.sleep(INTERVAL)
+            state = sample()
+        waited = time.monotonic() - start
+        logging.info('memory pressure: %s, starting %s after %.0fs', state,
+                     name, waited)
+        trace.annotate(deferred=round(waited, 3))
+    return guard
+
+
+def setup_argparse(parser):
+    parser.add_argument('--memory-guard',
+                        dest='apps_tools_memory_guard',
+                        action='store_true',
+                        help='Reduce the parallelism of the commands run ' +
+                        'by apps_tools under memory pressure')
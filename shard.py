@@ -0,0 +1,88 @@
+# Sharding of test runs: split tests between shards balanced by their
+# durations in earlier runs, merge the JUnit reports of the shards and
+# record the durations for the next run.
+import json
+import logging
+import os
+import statistics
+import xml.etree.ElementTree as ET
+
+# Duration of tests never run before
+_DEFAULT_DURATION = 1.0
+
+
+def load_durations(path):
+    # {test: seconds} recorded by save_durations, empty if none
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_durations(path, durations):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def balance(tests, durations, count):
+    # Split tests into at most count non empty shards of about the same
+    # duration: longest tests first, each one to the least loaded shard.
+    # Tests without recorded duration count as the median of the others.
+    known = [durations[t] for t in tests if t in durations]
+    default = statistics.median(known) if known else _DEFAULT_DURATION
+    weights = {t: durations.get(t, default) for t in tests}
+    shards = [[] for _ in range(min(count, len(tests)))]
+    loads = [0.0] * len(shards)
+    for test in sorted(tests, key=lambda t: (-weights[t], t)):
+        idx = loads.index(min(loads))
+        shards[idx].append(test)
+        loads[idx] += weights[test]
+    for idx, shard in enumerate(shards):
+        logging.debug('shard %d: %d tests, %.1fs expected', idx, len(shard),
+                      loads[idx])
+    return [sorted(shard) for shard in shards]
+
+
+def _suites(path):
+    # testsuite elements of a JUnit report
+    root = ET.parse(path).getroot()
+    if root.tag == 'testsuite':
+        return [root]
+    return root.findall('testsuite')
+
+
+def merge_junit(paths, dest):
+    # Merge the JUnit reports at paths (missing ones, of shards that did
+    # not start, are skipped) into dest. Return {test class: seconds}.
+    merged = ET.Element('testsuites')
+    totals = dict.fromkeys(('tests', 'failures', 'errors', 'skipped'), 0)
+    total_time = 0.0
+    durations = {}
+    for path in paths:
+        if not os.path.exists(path):
+            logging.warning('Missing test report %s', path)
+            continue
+        try:
+            suites = _suites(path)
+        except ET.ParseError as e:
+            logging.warning('Invalid test report %s: %s', path, e)
+            continue
+        for suite in suites:
+            merged.append(suite)
+            for key in totals:
+                totals[key] += int(suite.get(key, 0))
+            total_time += float(suite.get('time', 0))
+            for case in suite.iter('testcase'):
+                name = case.get('classname') or suite.get('name')
+                durations[name] = (durations.get(name, 0.0) +
+                                   float(case.get('time', 0)))
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    merged.set('time', '{:.3f}'.format(total_time))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    ET.ElementTree(merged).write(dest, encoding='UTF-8', xml_declaration=True)
+    return durations
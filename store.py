@@ -0,0 +1,177 @@
+# Local directory backed store of immutable files and directory trees with
+# size based LRU eviction. Keys are relative paths chosen by the users of
+# the store, the modification time of an entry records its last use.
+# Several processes can share a store: entries are added atomically and
+# eviction does not run while a tree is being restored.
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import apps_tools.fsutil as fsutil
+
+# File at the top of a tree entry, with its total size
+_TREE_MARKER = '.store-tree'
+
+
+class Store:
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def has(self, key):
+        # Check if an entry is there, marking it as used
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put_file(self, key, src):
+        # Add src under key if not already there. The entry is written
+        # aside and renamed so that a partial entry is never visible.
+        # Return True if the entry was added.
+        if self.has(key):
+            return False
+        dst = self.path(key)
+        tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return True
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        # Lock of the whole store, shared by readers of trees, exclusive
+        # for eviction
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put_tree(self, key, src, *, ignore=()):
+        # Add a copy of the src directory under key (files in ignore, names
+        # relative to src, excluded) if not already there. Files are copied
+        # (or reflinked), never hardlinked: src may be modified in place
+        # later. Return True if the entry was added.
+        if self.has(key):
+            return False
+        dst = self.path(key)
+        tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(src):
+                rel = os.path.relpath(dirpath, src)
+                dirnames[:] = [d for d in dirnames
+                               if os.path.normpath(os.path.join(rel, d))
+                               not in ignore]
+                os.makedirs(os.path.join(tmp, rel), exist_ok=True)
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    out = os.path.join(tmp, rel, name)
+                    if os.path.normpath(os.path.join(rel, name)) in ignore:
+                        continue
+                    if os.path.islink(path):
+                        os.symlink(os.readlink(path), out)
+                    elif name in filenames:
+                        fsutil.stage_file(path, out, hardlink=False)
+                        size += os.lstat(out).st_size
+            with open(os.path.join(tmp, _TREE_MARKER), 'w') as f:
+                json.dump({'size': size}, f)
+            os.rename(tmp, dst)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # Added by another process meanwhile
+            if os.path.exists(os.path.join(dst, _TREE_MARKER)):
+                return False
+            raise
+        return True
+
+    def restore_tree(self, key, dst):
+        # Recreate the tree entry key in dst (which must not exist) with
+        # hardlinks to the store files. Return False if there is no such
+        # entry.
+        with self.lock(shared=True):
+            if not self.has(key):
+                return False
+            src = self.path(key)
+            for dirpath, dirnames, filenames in os.walk(src):
+                out_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+                os.makedirs(out_dir, exist_ok=True)
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        os.symlink(os.readlink(path),
+                                   os.path.join(out_dir, name))
+                    elif name in filenames and name != _TREE_MARKER:
+                        try:
+                            os.link(path, os.path.join(out_dir, name))
+                        except OSError:
+                            shutil.copy2(path, os.path.join(out_dir, name))
+        return True
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames if d != '.tmp']
+                filenames = [f for f in filenames if f != '.lock']
+            if _TREE_MARKER in filenames:
+                # A tree is a single entry
+                dirnames[:] = []
+                with open(os.path.join(dirpath, _TREE_MARKER), 'r') as f:
+                    size = json.load(f)['size']
+                yield os.stat(dirpath).st_mtime, size, dirpath
+                continue
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self, keep=()):
+        # Remove least recently used entries until the store fits in
+        # max_size. Entries in keep are never removed.
+        if self.max_size is None:
+            return
+        keep = {self.path(key) for key in keep}
+        with self.lock():
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if path in keep:
+                    continue
+                if os.path.isdir(path):
+                    # Out of the way at once, removed afterwards
+                    tmp_dir = os.path.join(self.root, '.tmp')
+                    os.makedirs(tmp_dir, exist_ok=True)
+                    tmp = tempfile.mkdtemp(dir=tmp_dir)
+                    os.rename(path, os.path.join(tmp, 'tree'))
+                    shutil.rmtree(tmp)
+                else:
+                    os.unlink(path)
+                total -= size
+                removed += 1
+        if removed:
+            logging.info('Evicted %d entries from %s, %d bytes left',
+                         removed, self.root, total)
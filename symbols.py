@@ -0,0 +1,186 @@
+# Collection of unstripped native libraries (symbols) for releases
+import concurrent.futures
+import fnmatch
+import hashlib
+import logging
+import os
+import struct
+
+import apps_tools.archive as archive
+
+_PT_NOTE = 4
+_SHT_NOTE = 7
+_NT_GNU_BUILD_ID = 3
+
+
+def _parse_notes(data, endian):
+    pos = 0
+    while pos + 12 <= len(data):
+        namesz, descsz, ntype = struct.unpack_from(endian + 'III', data, pos)
+        pos += 12
+        name = data[pos:pos + namesz]
+        pos += (namesz + 3) & ~3
+        desc = data[pos:pos + descsz]
+        pos += (descsz + 3) & ~3
+        if ntype == _NT_GNU_BUILD_ID and name == b'GNU\0':
+            return desc.hex()
+    return None
+
+
+def read_build_id(path):
+    # Return the GNU build-id of an ELF file as an hex string, or None
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != b'\x7fELF':
+                return None
+            is64 = ident[4] == 2
+            endian = '<' if ident[5] == 1 else '>'
+            if is64:
+                hdr = f.read(48)
+                (phoff, shoff, _, _, phentsize, phnum, shentsize,
+                 shnum) = struct.unpack_from(endian + 'QQIHHHHH', hdr, 16)
+                phfmt, shfmt = 'IIQQQQ', 'IIQQQQ'
+            else:
+                hdr = f.read(36)
+                (phoff, shoff, _, _, phentsize, phnum, shentsize,
+                 shnum) = struct.unpack_from(endian + 'IIIHHHHH', hdr, 12)
+                phfmt, shfmt = 'IIIIII', 'IIIIII'
+            # Program headers first (always there in a linked library)
+            for i in range(phnum):
+                f.seek(phoff + i * phentsize)
+                ph = f.read(phentsize)
+                if is64:
+                    ptype, _, offset, _, _, size = struct.unpack_from(
+                        endian + phfmt, ph)
+                else:
+                    ptype, offset, _, _, size, _ = struct.unpack_from(
+                        endian + phfmt, ph)
+                if ptype != _PT_NOTE:
+                    continue
+                f.seek(offset)
+                build_id = _parse_notes(f.read(size), endian)
+                if build_id:
+                    return build_id
+            # Then note sections
+            for i in range(shnum):
+                f.seek(shoff + i * shentsize)
+                sh = f.read(shentsize)
+                _, shtype, _, _, offset, size = struct.unpack_from(
+                    endian + shfmt, sh)
+                if shtype != _SHT_NOTE:
+                    continue
+                f.seek(offset)
+                build_id = _parse_notes(f.read(size), endian)
+                if build_id:
+                    return build_id
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def scan(root, *, pattern='*.so', jobs=1):
+    # Find files matching pattern under root, like 'find . -name pattern'
+    # (symlinks to directories are not followed). Directories are listed
+    # concurrently and the build-id of each file is read on the way.
+    # Return a sorted list of (relpath, build_id).
+    def _scandir(path):
+        files, dirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif fnmatch.fnmatch(entry.name, pattern):
+                    build_id = None
+                    if not entry.is_symlink():
+                        build_id = read_build_id(entry.path)
+                    files.append((entry.path, build_id))
+        return files, dirs
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(_scandir, root)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                results.extend(files)
+                pending.update(executor.submit(_scandir, d) for d in dirs)
+    return sorted(('./' + os.path.relpath(path, root), build_id)
+                  for path, build_id in results)
+
+
+def write_index(index_file, entries):
+    # One 'build-id path' line per file having a build-id
+    with open(index_file, 'w') as f:
+        for relpath, build_id in entries:
+            if build_id:
+                f.write('{} {}\n'.format(build_id, relpath))
+
+
+def archive_symbols(root, dest, *, compression=None, jobs=1,
+                    index_file=None):
+    # Archive all libraries found under root in dest, and write the
+    # build-id index in index_file if given. Return (files, bytes).
+    entries = scan(root, jobs=jobs)
+    size = 0
+    with archive.open_tar(dest, backend=compression, threads=jobs) as tar:
+        for relpath, _ in entries:
+            path = os.path.join(root, relpath)
+            info = tar.gettarinfo(path, arcname=relpath)
+            if info.isreg():
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+                size += info.size
+            else:
+                tar.addfile(info)
+    if index_file:
+        write_index(index_file, entries)
+    logging.info('Archived %d symbol files (%d bytes) in %s',
+                 len(entries), size, dest)
+    return len(entries), size
+
+
+def _store_key(path, build_id):
+    # Libraries with a build-id use the .build-id layout of debuggers, so
+    # the store can directly be used as a debug file directory. Others are
+    # keyed by content.
+    if build_id:
+        return 'build-id', build_id, os.path.join(
+            '.build-id', build_id[:2], '{}.debug'.format(build_id[2:]))
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    return 'sha256', digest, os.path.join('sha256', digest[:2], digest[2:])
+
+
+def store_symbols(root, store, manifest_file, *, jobs=1):
+    # Add the libraries found under root to store, only copying the ones it
+    # does not have yet, and write the manifest of the release: one
+    # 'kind id path' line per library ('link target path' for symlinks).
+    # Return (files, added files, added bytes).
+    entries = scan(root, jobs=jobs)
+
+    def _add(entry):
+        relpath, build_id = entry
+        path = os.path.join(root, relpath)
+        if os.path.islink(path):
+            return ('link', os.readlink(path), relpath), None, None
+        kind, ident, key = _store_key(path, build_id)
+        size = os.path.getsize(path) if store.put_file(key, path) else None
+        return (kind, ident, relpath), key, size
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_add, entries))
+
+    with open(manifest_file, 'w') as f:
+        for line, _, _ in results:
+            f.write('{} {} {}\n'.format(*line))
+    added = [size for _, _, size in results if size is not None]
+    logging.info('Stored %d symbol files in %s: %d new (%d bytes)',
+                 len(results), store.root, len(added), sum(added))
+    store.evict(keep=[key for _, key, _ in results if key])
+    return len(results), len(added), sum(added)
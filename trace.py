@@ -0,0 +1,136 @@
+# Timing and resource usage of the hooks and commands run by apps_tools,
+# exported as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+_EVENTS = []
+_METADATA = {}
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+# ru_maxrss is in kilobytes on Linux, bytes on macOS
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def _write_bytes():
+    # Bytes written to storage by this process and its waited children
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def span(name, *, cat='hook', **args):
+    # Record the wall time, children cpu time, children peak rss and bytes
+    # written of the enclosed code. Children figures are process wide, so
+    # they are only accurate for spans that do not overlap other ones.
+    event = {'name': name, 'cat': cat, 'args': dict(args)}
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    stack.append(event)
+    start = time.time()
+    ru_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wb_start = _write_bytes()
+    try:
+        yield event
+    except BaseException:
+        event['args']['status'] = 'failed'
+        raise
+    finally:
+        end = time.time()
+        ru_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wb_end = _write_bytes()
+        stack.pop()
+        event['args']['cpu'] = round(
+            (ru_end.ru_utime - ru_start.ru_utime) +
+            (ru_end.ru_stime - ru_start.ru_stime), 3)
+        if ru_end.ru_maxrss > ru_start.ru_maxrss:
+            event['args']['peak_rss'] = ru_end.ru_maxrss * _RSS_UNIT
+        if wb_start is not None and wb_end is not None:
+            event['args']['written'] = wb_end - wb_start
+        event.update(ph='X', ts=int(start * 1e6),
+                     dur=int((end - start) * 1e6), pid=os.getpid(),
+                     tid=threading.get_native_id())
+        with _LOCK:
+            _EVENTS.append(event)
+
+
+def annotate(**args):
+    # Add information to the innermost span of the calling thread
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack:
+        stack[-1]['args'].update(args)
+
+
+def hook(kind, func):
+    # Wrap a dragon hook so that it is traced as '<task>:<kind>'
+    def _hook(task, args):
+        name = '{}:{}'.format(getattr(task, 'name', None) or '?', kind)
+        with span(name, cat='hook'):
+            return func(task, args)
+    return _hook
+
+
+def mark(name, **args):
+    # Record an instant event
+    with _LOCK:
+        _EVENTS.append({'name': name, 'cat': 'mark', 'args': args, 'ph': 'i',
+                        's': 'p', 'ts': int(time.time() * 1e6),
+                        'pid': os.getpid(),
+                        'tid': threading.get_native_id()})
+
+
+def set_metadata(key, value):
+    # Saved in the otherData section of the trace
+    with _LOCK:
+        _METADATA[key] = value
+
+
+def events():
+    with _LOCK:
+        return list(_EVENTS)
+
+
+def write(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        with _LOCK:
+            metadata = dict(_METADATA)
+        json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms',
+                   'otherData': metadata}, f)
+
+
+def _fmt_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '{:.0f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}T'.format(size)
+
+
+def summary():
+    # Lines of a table of the recorded spans, in start order
+    lines = ['{:<48} {:>9} {:>9} {:>8} {:>8}'.format(
+        'name', 'wall(s)', 'cpu(s)', 'rss', 'written')]
+    for event in sorted(events(), key=lambda e: e['ts']):
+        if event['ph'] != 'X':
+            continue
+        args = event['args']
+        lines.append('{:<48} {:>9.2f} {:>9.2f} {:>8} {:>8}{}'.format(
+            event['name'][:48], event['dur'] / 1e6, args.get('cpu', 0),
+            _fmt_size(args.get('peak_rss')), _fmt_size(args.get('written')),
+            ' (failed)' if args.get('status') == 'failed' else ''))
+    return lines